@@ -14,17 +14,13 @@ import jdecode
 import cardlib
 from cbow import CBOW
 from namediff import Namediff
+from jdecode import exclude_sets
 
-def exclude_sets(cardset):
-    return cardset == 'Unglued' or cardset == 'Unhinged' or cardset == 'Celebration'
+# number of cards to look up in the cbow model at once with --creativity
+block_size = 64
 
 def main(fname, oname = None, verbose = True, 
          gatherer = False, for_forum = False, creativity = False, norarity = False, for_mse = False):
-    cards = []
-    valid = 0
-    invalid = 0
-    unparsed = 0
-
     if norarity:
         decode_fields = [
             cardlib.field_name,
@@ -40,86 +36,84 @@ def main(fname, oname = None, verbose = True,
     else:
         decode_fields = cardlib.fmt_ordered_default
 
+    # Cards are only read as we write them out, so none of this is known until the end.
+    stats = {
+        'valid' : 0,
+        'invalid' : 0,
+        'unparsed' : 0,
+        # for the legacy format heuristic, which only looks at the first few cards
+        'good' : 0,
+        'bad' : 0,
+    }
+    def tally(card):
+        if card.valid:
+            stats['valid'] += 1
+        elif card.parsed:
+            stats['invalid'] += 1
+        else:
+            stats['unparsed'] += 1
+        if stats['good'] + stats['bad'] <= 15:
+            if not card.parsed and not card.text.text:
+                stats['bad'] += 1
+            else:
+                stats['good'] += 1
+
     if fname[-5:] == '.json':
         if verbose:
             print 'This looks like a json file: ' + fname
-        json_srcs = jdecode.mtg_open_json(fname, verbose)
-        for json_cardname in sorted(json_srcs):
-            if len(json_srcs[json_cardname]) > 0:
-                jcards = json_srcs[json_cardname]
-
-                # look for a normal rarity version, in a set we can use
-                idx = 0
-                card = cardlib.Card(jcards[idx], fmt_ordered = decode_fields)
-                while (idx < len(jcards)
-                       and (card.rarity == utils.rarity_special_marker 
-                            or exclude_sets(jcards[idx][utils.json_field_set_name]))):
-                    idx += 1
-                    if idx < len(jcards):
-                        card = cardlib.Card(jcards[idx], fmt_ordered = decode_fields)
-                # if there isn't one, settle with index 0
-                if idx >= len(jcards):
+        json_srcs = jdecode.mtg_reduce_json(fname, prefer = jdecode.prefer_printing,
+                                             verbose = verbose, cache = True)
+        def read_cards():
+            for json_cardname in sorted(json_srcs):
+                if len(json_srcs[json_cardname]) > 0:
+                    jcards = json_srcs[json_cardname]
+
+                    # look for a normal rarity version, in a set we can use
                     idx = 0
                     card = cardlib.Card(jcards[idx], fmt_ordered = decode_fields)
-                # we could go back and look for a card satisfying one of the criteria,
-                # but eh
-
-                if card.valid:
-                    valid += 1
-                elif card.parsed:
-                    invalid += 1
-                else:
-                    unparsed += 1
-                cards += [card]
-
-    # fall back to opening a normal encoded file
-    else:
-        if verbose:
-            print 'Opening encoded card file: ' + fname
-        with open(fname, 'rt') as f:
-            text = f.read()
-        for card_src in text.split(utils.cardsep):
-            if card_src:
-                card = cardlib.Card(card_src, fmt_ordered = decode_fields)
-                if card.valid:
-                    valid += 1
-                elif card.parsed:
-                    invalid += 1
-                else:
-                    unparsed += 1
-                cards += [card]
+                    while (idx < len(jcards)
+                           and (card.rarity == utils.rarity_special_marker 
+                                or exclude_sets(jcards[idx][utils.json_field_set_name]))):
+                        idx += 1
+                        if idx < len(jcards):
+                            card = cardlib.Card(jcards[idx], fmt_ordered = decode_fields)
+                    # if there isn't one, settle with index 0
+                    if idx >= len(jcards):
+                        idx = 0
+                        card = cardlib.Card(jcards[idx], fmt_ordered = decode_fields)
+                    # we could go back and look for a card satisfying one of the criteria,
+                    # but eh
 
-    if verbose:
-        print (str(valid) + ' valid, ' + str(invalid) + ' invalid, ' 
-               + str(unparsed) + ' failed to parse.')
-
-    good_count = 0
-    bad_count = 0
-    for card in cards:
-        if not card.parsed and not card.text.text:
-            bad_count += 1
+                    yield card
+
+    # fall back to reading a normal encoded file, a card at a time
+    else:
+        if fname == '-':
+            if verbose:
+                print 'Reading encoded cards from stdin'
+            def read_cards():
+                for card_src in utils.stream_cards(sys.stdin):
+                    yield cardlib.Card(card_src, fmt_ordered = decode_fields)
         else:
-            good_count += 1
-        if good_count + bad_count > 15: 
-            break
-    # random heuristic
-    if bad_count > 10:
-        print 'Saw a bunch of unparsed cards with no text:'
-        print 'If this is a legacy format, try rerunning with --norarity'
+            if verbose:
+                print 'Opening encoded card file: ' + fname
+            def read_cards():
+                with open(fname, 'rt') as f:
+                    for card_src in utils.stream_cards(f):
+                        yield cardlib.Card(card_src, fmt_ordered = decode_fields)
 
     if creativity:
         cbow = CBOW()
         namediff = Namediff()
 
-    def writecards(writer):
-        if for_mse:
-            # have to prepend a massive chunk.
-            writer.write(utils.mse_prepend)
-        for card in cards:
+    def writeblock(writer, block):
+        if creativity and not for_mse:
+            block_nearest = cbow.nearest_batch(block)
+        for i, card in enumerate(block):
             writer.write((card.format(gatherer = gatherer, for_forum = for_forum, for_mse = for_mse)))
             if creativity and not for_mse: # this won't end well if mse mode is enabled.
                 writer.write('~~ closest cards ~~\n'.encode('utf-8'))
-                nearest = cbow.nearest(card)
+                nearest = block_nearest[i]
                 for dist, cardname in nearest:
                     cardname = namediff.names[cardname]
                     if for_forum:
@@ -133,6 +127,20 @@ def main(fname, oname = None, verbose = True,
                         cardname = '[card]' + cardname + '[/card]'
                     writer.write((cardname + ': ' + str(dist) + '\n').encode('utf-8'))
             writer.write('\n'.encode('utf-8'))
+
+    def writecards(writer):
+        if for_mse:
+            # have to prepend a massive chunk.
+            writer.write(utils.mse_prepend)
+        # cards are handled a block at a time so the cbow lookups can be batched
+        block = []
+        for card in read_cards():
+            tally(card)
+            block += [card]
+            if len(block) >= block_size:
+                writeblock(writer, block)
+                block = []
+        writeblock(writer, block)
         if for_mse:
             writer.write('version control:\n\ttype: none\napprentice code: ') # have to append some junk at the end of file.
 
@@ -156,13 +164,22 @@ def main(fname, oname = None, verbose = True,
         writecards(sys.stdout)
         sys.stdout.flush()
 
+    if verbose:
+        print (str(stats['valid']) + ' valid, ' + str(stats['invalid']) + ' invalid, ' 
+               + str(stats['unparsed']) + ' failed to parse.')
+
+    # random heuristic
+    if stats['bad'] > 10:
+        print 'Saw a bunch of unparsed cards with no text:'
+        print 'If this is a legacy format, try rerunning with --norarity'
+
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     
     parser.add_argument('infile', #nargs='?'. default=None,
-                        help='encoded card file or json corpus to encode')
+                        help='encoded card file or json corpus to encode, or - for stdin')
     parser.add_argument('outfile', nargs='?', default=None,
                         help='output file, defaults to stdout')
     parser.add_argument('-g', '--gatherer', action='store_true',
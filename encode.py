@@ -6,12 +6,13 @@ libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib')
 sys.path.append(libdir)
 import re
 import random
+import itertools
+import multiprocessing
+import gc
 import utils
 import jdecode
 import cardlib
-
-def exclude_sets(cardset):
-    return cardset == 'Unglued' or cardset == 'Unhinged' or cardset == 'Celebration'
+from jdecode import exclude_sets
 
 def exclude_types(cardtype):
     return cardtype in ['conspiracy']
@@ -19,7 +20,130 @@ def exclude_types(cardtype):
 def exclude_layouts(layout):
     return layout in ['token', 'plane', 'scheme', 'phenomenon', 'vanguard']
 
-def main(fname, oname = None, verbose = True, dupes = 0, encoding = 'std', stable = False):
+# Per-card work for main(), split out so it can be farmed out to other processes.
+# Each returns the card's status along with the card itself, if we're keeping it.
+def parse_json_group(jcards):
+    # look for a normal rarity version, in a set we can use
+    idx = 0
+    card = cardlib.Card(jcards[idx])
+    while (idx < len(jcards)
+           and (card.rarity == utils.rarity_special_marker 
+                or exclude_sets(jcards[idx][utils.json_field_set_name]))):
+        idx += 1
+        if idx < len(jcards):
+            card = cardlib.Card(jcards[idx])
+    # if there isn't one, settle with index 0
+    if idx >= len(jcards):
+        idx = 0
+        card = cardlib.Card(jcards[idx])
+    # we could go back and look for a card satisfying one of the criteria,
+    # but eh
+
+    skip = False
+    if (exclude_sets(jcards[idx][utils.json_field_set_name])
+        or exclude_layouts(jcards[idx]['layout'])):
+        skip = True                    
+    for cardtype in card.types:
+        if exclude_types(cardtype):
+            skip = True
+    if skip:
+        return 'skipped', None
+    return parse_status(card)
+
+def parse_text_card(card_src):
+    return parse_status(cardlib.Card(card_src))
+
+def parse_status(card):
+    if card.valid:
+        strip_card(card)
+        return 'valid', card
+    elif card.parsed:
+        return 'invalid', None
+    else:
+        return 'unparsed', None
+
+# Nothing in here ever looks at the raw fields, so drop them to save memory and time
+# spent pickling for other processes. The per-line and per-word views of the text are
+# never built unless someone asks for them.
+def strip_card(card):
+    card.fields = None
+    if card.bside:
+        strip_card(card.bside)
+
+# The workers and the main process unpickle huge numbers of small objects that can't
+# form cycles, which keeps setting off the garbage collector for nothing.
+def init_worker():
+    gc.disable()
+
+# Append the encoding of each card to out. The same card shows up many times when
+# we're duplicating, so if the encoding can't come out differently each time, pass
+# in a dict for memo and each card will only be encoded once.
+def encode_cards(cards, encoding, plan, out, memo = None):
+    for card in cards:
+        if memo is not None and card in memo:
+            out += [memo[card]]
+        elif encoding in ['vec']:
+            cardstr = card.vectorize() + '\n\n'
+            if memo is not None:
+                memo[card] = cardstr
+            out += [cardstr]
+        elif memo is not None:
+            cardout = []
+            plan.emit(card, cardout)
+            cardout += [utils.cardsep]
+            memo[card] = ''.join(cardout)
+            out += [memo[card]]
+        else:
+            plan.emit(card, out)
+            out += [utils.cardsep]
+
+def encode_memo(encoding, plan):
+    if encoding in ['vec'] or not plan.randomized:
+        return {}
+    else:
+        return None
+
+# In python 2, random.sample(x, len(x)) and random.shuffle(x) both call random.random()
+# a fixed number of times for a given length of x, so this only depends on the shape of
+# the card. That lets us work out where the generator would be at the start of any card
+# without encoding everything before it.
+def encode_draws(card, plan):
+    draws = 0
+    if plan.randomize_mana:
+        for field in plan.fmt_ordered:
+            if field == cardlib.field_cost:
+                costs = [card.cost]
+            elif field == cardlib.field_text:
+                costs = card.text.costs
+            else:
+                costs = []
+            for cost in costs:
+                if not cost.none:
+                    draws += len(cost.sequence)
+    if plan.randomize_fields:
+        draws += max(len(plan.fmt_ordered) - 1, 0)
+    if card.bside:
+        draws += encode_draws(card.bside, plan)
+    return draws
+
+# Encode a run of cards starting from the given generator state, and make sure
+# we ended up where the serial encoding would have.
+def encode_chunk(args):
+    chunk, encoding, plan, state, end_state = args
+    if state:
+        random.setstate(state)
+    out = []
+    encode_cards(chunk, encoding, plan, out, encode_memo(encoding, plan))
+    outstr = ''.join(out)
+    if state and random.getstate() != end_state:
+        raise ValueError('encode.py: random draws out of step with the serial encoding')
+    return outstr
+
+# number of cards handed to a worker at a time
+chunk_size = 1000
+
+def main(fname, oname = None, verbose = True, dupes = 0, encoding = 'std', stable = False,
+         jobs = 1):
     fmt_ordered = cardlib.fmt_ordered_default
     fmt_labeled = None
     fieldsep = utils.fieldsep
@@ -71,49 +195,25 @@ def main(fname, oname = None, verbose = True, dupes = 0, encoding = 'std', stabl
     invalid = 0
     unparsed = 0
 
+    if jobs > 1:
+        if verbose:
+            print '  Using ' + str(jobs) + ' processes.'
+        pool = multiprocessing.Pool(jobs, init_worker)
+        gc.disable()
+        pmap = lambda f, srcs: pool.imap(f, srcs, chunksize = 64)
+    else:
+        pool = None
+        pmap = itertools.imap
+
     if fname[-5:] == '.json':
         if verbose:
             print 'This looks like a json file: ' + fname
-        json_srcs = jdecode.mtg_open_json(fname, verbose)
+        json_srcs = jdecode.mtg_reduce_json(fname, prefer = jdecode.prefer_printing,
+                                             verbose = verbose, cache = True)
         # don't worry we randomize later
-        for json_cardname in sorted(json_srcs):
-            if len(json_srcs[json_cardname]) > 0:
-                jcards = json_srcs[json_cardname]
-
-                # look for a normal rarity version, in a set we can use
-                idx = 0
-                card = cardlib.Card(jcards[idx])
-                while (idx < len(jcards)
-                       and (card.rarity == utils.rarity_special_marker 
-                            or exclude_sets(jcards[idx][utils.json_field_set_name]))):
-                    idx += 1
-                    if idx < len(jcards):
-                        card = cardlib.Card(jcards[idx])
-                # if there isn't one, settle with index 0
-                if idx >= len(jcards):
-                    idx = 0
-                    card = cardlib.Card(jcards[idx])
-                # we could go back and look for a card satisfying one of the criteria,
-                # but eh
-
-                skip = False
-                if (exclude_sets(jcards[idx][utils.json_field_set_name])
-                    or exclude_layouts(jcards[idx]['layout'])):
-                    skip = True                    
-                for cardtype in card.types:
-                    if exclude_types(cardtype):
-                        skip = True
-                if skip:
-                    skipped += 1
-                    continue
-                
-                if card.valid:
-                    valid += 1
-                    cards += [card] * dupes
-                elif card.parsed:
-                    invalid += 1
-                else:
-                    unparsed += 1
+        srcs = [json_srcs[json_cardname] for json_cardname in sorted(json_srcs)
+                if len(json_srcs[json_cardname]) > 0]
+        parse = parse_json_group
 
     # fall back to opening a normal encoded file
     else:
@@ -121,16 +221,19 @@ def main(fname, oname = None, verbose = True, dupes = 0, encoding = 'std', stabl
             print 'Opening encoded card file: ' + fname
         with open(fname, 'rt') as f:
             text = f.read()
-        for card_src in text.split(utils.cardsep):
-            if card_src:
-                card = cardlib.Card(card_src)
-                if card.valid:
-                    valid += 1
-                    cards += [card] * dupes
-                elif card.parsed:
-                    invalid += 1
-                else:
-                    unparsed += 1
+        srcs = [card_src for card_src in text.split(utils.cardsep) if card_src]
+        parse = parse_text_card
+
+    for status, card in pmap(parse, srcs):
+        if status == 'valid':
+            valid += 1
+            cards += [card] * dupes
+        elif status == 'skipped':
+            skipped += 1
+        elif status == 'invalid':
+            invalid += 1
+        else:
+            unparsed += 1
 
     if verbose:
         print (str(valid) + ' valid, ' + str(skipped) + ' skipped, ' 
@@ -142,19 +245,38 @@ def main(fname, oname = None, verbose = True, dupes = 0, encoding = 'std', stabl
         random.seed(1371367)
         random.shuffle(cards)
 
+    plan = cardlib.EncodePlan(fmt_ordered = fmt_ordered,
+                              fmt_labeled = fmt_labeled,
+                              fieldsep = fieldsep,
+                              randomize_fields = randomize_fields,
+                              randomize_mana = randomize_mana,
+                              initial_sep = initial_sep,
+                              final_sep = final_sep)
+
     def writecards(writer):
-        for card in cards:
-            if encoding in ['vec']:
-                writer.write(card.vectorize() + '\n\n')
+        if pool is None:
+            memo = encode_memo(encoding, plan)
+            for i in range(0, len(cards), chunk_size):
+                out = []
+                encode_cards(cards[i:i + chunk_size], encoding, plan, out, memo)
+                writer.write(''.join(out))
+            return
+
+        chunks = []
+        for i in range(0, len(cards), chunk_size):
+            chunk = cards[i:i + chunk_size]
+            if encoding not in ['vec'] and (randomize_fields or randomize_mana):
+                # step the generator past this chunk's draws on our side
+                state = random.getstate()
+                for _ in xrange(sum([encode_draws(card, plan) for card in chunk])):
+                    random.random()
+                end_state = random.getstate()
             else:
-                writer.write(card.encode(fmt_ordered = fmt_ordered,
-                                         fmt_labeled = fmt_labeled,
-                                         fieldsep = fieldsep,
-                                         randomize_fields = randomize_fields,
-                                         randomize_mana = randomize_mana,
-                                         initial_sep = initial_sep,
-                                         final_sep = final_sep) 
-                             + utils.cardsep)
+                state = None
+                end_state = None
+            chunks += [(chunk, encoding, plan, state, end_state)]
+        for outstr in pool.imap(encode_chunk, chunks):
+            writer.write(outstr)
 
     if oname:
         if verbose:
@@ -165,6 +287,11 @@ def main(fname, oname = None, verbose = True, dupes = 0, encoding = 'std', stabl
         writecards(sys.stdout)
         sys.stdout.flush()
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+        gc.enable()
+
 
 if __name__ == '__main__':
     import argparse
@@ -180,11 +307,13 @@ if __name__ == '__main__':
                         choices=['std', 'rmana', 'rmana_dual', 'rfields', 'vec'])
     parser.add_argument('-s', '--stable', action='store_true',
                         help="don't randomize the order of the cards")
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='number of processes to use for parsing and encoding')
     parser.add_argument('-v', '--verbose', action='store_true', 
                         help='verbose output')
     
     args = parser.parse_args()
     main(args.infile, args.outfile, verbose = args.verbose, dupes = args.duplicate,
-         encoding = args.encoding, stable = args.stable)
+         encoding = args.encoding, stable = args.stable, jobs = args.jobs)
     exit(0)
 
@@ -5,7 +5,7 @@ import random
 
 import utils
 import transforms
-from manalib import Manacost, Manatext
+from manalib import Manacost, Manatext, intern_manacost
 from titlecase import titlecase
 
 # Some text prettification stuff that people may not have installed
@@ -172,7 +172,10 @@ def uppercaseNewLineAndFullstop(string):
 # releaseDate - string
 # starter - boolean
 
-def fields_from_json(src_json):
+# With compiled = False, the text goes through each of the text passes one after
+# another, instead of through transforms.text_pass_compiled. The results are the
+# same either way; it's only there to compare against.
+def fields_from_json(src_json, compiled = True):
     parsed = True
     valid = True
     fields = {}
@@ -190,7 +193,7 @@ def fields_from_json(src_json):
 
     # return the actual Manacost object
     if 'manaCost' in src_json:
-        cost =  Manacost(src_json['manaCost'], fmt = 'json')
+        cost =  intern_manacost(src_json['manaCost'], fmt = 'json')
         valid = valid and cost.valid
         parsed = parsed and cost.parsed
         fields[field_cost] = [(-1, cost)]
@@ -239,18 +242,21 @@ def fields_from_json(src_json):
     # similarly, return the actual Manatext object
     if 'text' in src_json:
         text_val = src_json['text'].lower()
-        text_val = transforms.text_pass_1_strip_rt(text_val)
-        text_val = transforms.text_pass_2_cardname(text_val, name_orig)
-        text_val = transforms.text_pass_3_unary(text_val)
-        text_val = transforms.text_pass_4a_dashes(text_val)
-        text_val = transforms.text_pass_4b_x(text_val)
-        text_val = transforms.text_pass_5_counters(text_val)
-        text_val = transforms.text_pass_6_uncast(text_val)
-        text_val = transforms.text_pass_7_choice(text_val)
-        text_val = transforms.text_pass_8_equip(text_val)
-        text_val = transforms.text_pass_9_newlines(text_val)
-        text_val = transforms.text_pass_10_symbols(text_val)
-        text_val = utils.to_ascii(text_val)
+        if compiled:
+            text_val = transforms.text_pass_compiled(text_val, name_orig)
+        else:
+            text_val = transforms.text_pass_1_strip_rt(text_val)
+            text_val = transforms.text_pass_2_cardname(text_val, name_orig)
+            text_val = transforms.text_pass_3_unary(text_val)
+            text_val = transforms.text_pass_4a_dashes(text_val)
+            text_val = transforms.text_pass_4b_x(text_val)
+            text_val = transforms.text_pass_5_counters(text_val)
+            text_val = transforms.text_pass_6_uncast(text_val)
+            text_val = transforms.text_pass_7_choice(text_val)
+            text_val = transforms.text_pass_8_equip(text_val)
+            text_val = transforms.text_pass_9_newlines(text_val)
+            text_val = transforms.text_pass_10_symbols(text_val)
+            text_val = utils.to_ascii(text_val)
         text_val = text_val.strip()
         mtext = Manatext(text_val, fmt = 'json')
         valid = valid and mtext.valid
@@ -260,82 +266,289 @@ def fields_from_json(src_json):
     return parsed, valid and fields_check_valid(fields), fields
 
 
-def fields_from_format(src_text, fmt_ordered, fmt_labeled, fieldsep):
-    parsed = True
-    valid = True
-    fields = {}
+# A card format, compiled once from fmt_ordered, fmt_labeled and fieldsep so that
+# parsing a card doesn't have to work any of it out again.
 
-    if fmt_labeled:
-        labels = {fmt_labeled[k] : k for k in fmt_labeled}
-        field_label_regex = '[' + ''.join(labels.keys()) + ']'
-    def addf(fields, fkey, fval):
-        # make sure you pass a pair
-        if fval and fval[1]:
-            if fkey in fields:
-                fields[fkey] += [fval]
-            else:
-                fields[fkey] = [fval]
-
-    textfields = src_text.split(fieldsep)
-    idx = 0
-    true_idx = 0
-    for textfield in textfields:
-        # ignore leading or trailing empty fields due to seps
-        if textfield == '':
-            if true_idx == 0 or true_idx == len(textfields) - 1:
-                true_idx += 1
-                continue
-            # count the field index for other empty fields but don't add them
-            else:
-                idx += 1
-                true_idx += 1
-                continue
+# Nearly every card we see is laid out the way we write them: a field separator at
+# each end, and either a label as the first character of every field or no labels
+# anywhere. parse() handles that case directly. Anything else is handed to
+# parse_general(), which is the original, fully general algorithm.
 
-        lab = None
-        if fmt_labeled:
-            labs = re.findall(field_label_regex, textfield)
-            # use the first label if we saw any at all
-            if len(labs) > 0:
-                lab = labs[0]
-                textfield = textfield.replace(lab, '', 1)
-        # try to use the field label if we got one
-        if lab and lab in labels:
-            fname = labels[lab]
-        # fall back to the field order specified
-        elif idx < len(fmt_ordered):
-            fname = fmt_ordered[idx]
-        # we don't know what to do with this field: call it other
-        else:
-            fname = field_other
-            parsed = False
-            valid = False
+class CardFormat(object):
+    '''compiled parser for one encoded card format'''
 
-        # specialized handling
-        if fname in [field_cost]:
-            fval = Manacost(textfield)
-            parsed = parsed and fval.parsed
-            valid = valid and fval.valid
-            addf(fields, fname, (idx, fval))
-        elif fname in [field_text]:
+    def __init__(self, fmt_ordered, fmt_labeled, fieldsep):
+        self.fmt_ordered = list(fmt_ordered)
+        self.fmt_labeled = dict(fmt_labeled) if fmt_labeled else None
+        self.fieldsep = fieldsep
+        if self.fmt_labeled:
+            self.labels = {self.fmt_labeled[k] : k for k in self.fmt_labeled}
+            self.field_label_regex = re.compile(
+                '[' + ''.join(map(re.escape, self.labels.keys())) + ']')
+        else:
+            self.labels = None
+            self.field_label_regex = None
+        # the fields that are lists of words
+        self.list_fields = set([field_supertypes, field_types, field_subtypes])
+
+    # Turn the text of one field into its value, updating the parsed and valid flags.
+    def field_value(self, fname, textfield, parsed, valid):
+        if fname == field_text:
             fval = Manatext(textfield)
             valid = valid and fval.valid
-            addf(fields, fname, (idx, fval))
-        elif fname in [field_supertypes, field_types, field_subtypes]:
-            addf(fields, fname, (idx, textfield.split()))
+        elif fname == field_cost:
+            fval = intern_manacost(textfield)
+            parsed = parsed and fval.parsed
+            valid = valid and fval.valid
+        elif fname in self.list_fields:
+            fval = textfield.split()
         else:
-            addf(fields, fname, (idx, textfield))
+            fval = textfield
+        return fval, parsed, valid
+
+    def parse(self, src_text):
+        textfields = src_text.split(self.fieldsep)
+        if not (textfields[0] == '' and textfields[-1] == ''):
+            return self.parse_general(src_text)
+
+        # Labels are optional even for labeled formats, and the usual unlabeled
+        # text has no label characters in it at all.
+        labels = self.labels
+        if labels and not self.field_label_regex.search(src_text):
+            labels = None
+
+        parsed = True
+        valid = True
+        fields = {}
+        fmt_ordered = self.fmt_ordered
+        list_fields = self.list_fields
+        for idx, textfield in enumerate(textfields[1:-1]):
+            # count the field index for empty fields but don't add them
+            if textfield == '':
+                continue
+            if labels:
+                lab = textfield[0]
+                if not lab in labels:
+                    return self.parse_general(src_text)
+                fname = labels[lab]
+                textfield = textfield[1:]
+            elif idx < len(fmt_ordered):
+                fname = fmt_ordered[idx]
+            else:
+                return self.parse_general(src_text)
+
+            # same as field_value(), but this is the inner loop
+            if fname == field_text:
+                fval = Manatext(textfield)
+                valid = valid and fval.valid
+            elif fname == field_cost:
+                fval = intern_manacost(textfield)
+                parsed = parsed and fval.parsed
+                valid = valid and fval.valid
+            elif fname in list_fields:
+                fval = textfield.split()
+            else:
+                fval = textfield
+            if fval:
+                if fname in fields:
+                    fields[fname] += [(idx, fval)]
+                else:
+                    fields[fname] = [(idx, fval)]
 
-        idx += 1
-        true_idx += 1
-        
-    # again, bsides are handled by the constructor
-    return parsed, valid and fields_check_valid(fields), fields
+        return parsed, valid and fields_check_valid(fields), fields
+
+    def parse_general(self, src_text):
+        parsed = True
+        valid = True
+        fields = {}
+
+        def addf(fields, fkey, fval):
+            # make sure you pass a pair
+            if fval and fval[1]:
+                if fkey in fields:
+                    fields[fkey] += [fval]
+                else:
+                    fields[fkey] = [fval]
+
+        textfields = src_text.split(self.fieldsep)
+        idx = 0
+        true_idx = 0
+        for textfield in textfields:
+            # ignore leading or trailing empty fields due to seps
+            if textfield == '':
+                if true_idx == 0 or true_idx == len(textfields) - 1:
+                    true_idx += 1
+                    continue
+                # count the field index for other empty fields but don't add them
+                else:
+                    idx += 1
+                    true_idx += 1
+                    continue
+
+            lab = None
+            if self.labels:
+                labs = self.field_label_regex.findall(textfield)
+                # use the first label if we saw any at all
+                if len(labs) > 0:
+                    lab = labs[0]
+                    textfield = textfield.replace(lab, '', 1)
+            # try to use the field label if we got one
+            if lab and lab in self.labels:
+                fname = self.labels[lab]
+            # fall back to the field order specified
+            elif idx < len(self.fmt_ordered):
+                fname = self.fmt_ordered[idx]
+            # we don't know what to do with this field: call it other
+            else:
+                fname = field_other
+                parsed = False
+                valid = False
+
+            fval, parsed, valid = self.field_value(fname, textfield, parsed, valid)
+            addf(fields, fname, (idx, fval))
+
+            idx += 1
+            true_idx += 1
+
+        # again, bsides are handled by the constructor
+        return parsed, valid and fields_check_valid(fields), fields
+
+# Compiled formats, by everything that goes into them. There are only ever a few,
+# and almost always the same one as last time, which is cheaper to check for than
+# to build a key.
+card_formats = {}
+card_format_last = [None]
+
+def compile_format(fmt_ordered, fmt_labeled, fieldsep):
+    last = card_format_last[0]
+    if (last is not None and last.fieldsep == fieldsep and last.fmt_ordered == fmt_ordered
+        and last.fmt_labeled == (fmt_labeled or None)):
+        return last
+    key = (tuple(fmt_ordered),
+           tuple(sorted(fmt_labeled.items())) if fmt_labeled else None,
+           fieldsep)
+    if not key in card_formats:
+        card_formats[key] = CardFormat(fmt_ordered, fmt_labeled, fieldsep)
+    card_format_last[0] = card_formats[key]
+    return card_formats[key]
+
+def fields_from_format(src_text, fmt_ordered, fmt_labeled, fieldsep):
+    return compile_format(fmt_ordered, fmt_labeled, fieldsep).parse(src_text)
+
+# The numeric value of a field like power or loyalty, or None if it isn't a number.
+def int_value(s):
+    if s is None:
+        return None
+    try:
+        return int(s)
+    except ValueError:
+        return None
+
+# An output plan for Card.encode(), compiled once from the encoding's options so
+# that encoding a card is just a walk over a list of prepared fields. emit() appends
+# the encoded card to a list that the caller can keep adding to and join at the end.
+
+class EncodePlan(object):
+    '''compiled encoder for one set of Card.encode() options'''
+
+    def __init__(self, fmt_ordered = fmt_ordered_default,
+                 fmt_labeled = None, fieldsep = utils.fieldsep,
+                 randomize_fields = False, randomize_mana = False,
+                 initial_sep = True, final_sep = True):
+        self.fmt_ordered = list(fmt_ordered)
+        self.fmt_labeled = dict(fmt_labeled) if fmt_labeled else None
+        self.fieldsep = fieldsep
+        self.randomize_fields = randomize_fields
+        self.randomize_mana = randomize_mana
+        self.initial_sep = initial_sep
+        self.final_sep = final_sep
+        # only randomized encodings can come out differently for the same card
+        self.randomized = randomize_fields or randomize_mana
+
+        # (field, how to encode it, label) for each field in order
+        self.fields = []
+        for field in self.fmt_ordered:
+            if not field in fieldnames:
+                raise ValueError('unknown field for Card.encode(): ' + str(field))
+            if field in [field_supertypes, field_types, field_subtypes]:
+                kind = 'list'
+            elif field in [field_cost, field_text]:
+                kind = 'mana'
+            else:
+                kind = 'str'
+            if self.fmt_labeled and field in self.fmt_labeled:
+                label = self.fmt_labeled[field]
+            else:
+                label = ''
+            self.fields += [(field, kind, label)]
+        self.head = [''] if initial_sep else []
+        self.tail = [''] if final_sep else []
+
+    def emit(self, card, out):
+        randomize_mana = self.randomize_mana
+        outfields = []
+        for field, kind, label in self.fields:
+            outfield = getattr(card, field)
+            if not outfield:
+                outfield_str = ''
+            elif kind == 'mana':
+                outfield_str = outfield.encode(randomize = randomize_mana)
+            elif kind == 'list':
+                outfield_str = ' '.join(outfield)
+            else:
+                outfield_str = outfield
+            if label:
+                outfield_str = label + outfield_str
+            outfields += [outfield_str]
+
+        if self.randomize_fields:
+            random.shuffle(outfields)
+        out += [self.fieldsep.join(self.head + outfields + self.tail)]
+
+        if card.bside:
+            out += [utils.bsidesep]
+            self.emit(card.bside, out)
+
+# Plans made by Card.encode() when it isn't given one, by everything that goes
+# into them. As with the formats above, the last one used is checked first.
+encode_plans = {}
+encode_plan_last = [None]
+
+def compile_plan(fmt_ordered, fmt_labeled, fieldsep, randomize_fields, randomize_mana,
+                 initial_sep, final_sep):
+    last = encode_plan_last[0]
+    if (last is not None and last.fmt_ordered == fmt_ordered
+        and last.fmt_labeled == (fmt_labeled or None) and last.fieldsep == fieldsep
+        and last.randomize_fields == randomize_fields
+        and last.randomize_mana == randomize_mana
+        and last.initial_sep == initial_sep and last.final_sep == final_sep):
+        return last
+    key = (tuple(fmt_ordered),
+           tuple(sorted(fmt_labeled.items())) if fmt_labeled else None,
+           fieldsep, randomize_fields, randomize_mana, initial_sep, final_sep)
+    if not key in encode_plans:
+        encode_plans[key] = EncodePlan(fmt_ordered, fmt_labeled, fieldsep,
+                                       randomize_fields, randomize_mana,
+                                       initial_sep, final_sep)
+    encode_plan_last[0] = encode_plans[key]
+    return encode_plans[key]
 
 # Here's the actual Card class that other files should use.
 
-class Card:
+class Card(object):
     '''card representation with data'''
 
+    # There can be a lot of these around at once, so they don't get an instance
+    # dict; every attribute has to be listed here. The derived views (text_lines,
+    # text_words, and the numeric values of loyalty and p/t) are properties that
+    # work out their values when first asked for and keep them in the underscored
+    # slots, which stay unset until then.
+    __slots__ = ['json', 'raw', 'parsed', 'valid', 'bside', 'fields',
+                 'name', 'rarity', 'cost', 'supertypes', 'types', 'subtypes',
+                 'loyalty', '_loyalty_value',
+                 'pt', 'pt_p', '_pt_p_value', 'pt_t', '_pt_t_value',
+                 'text', '_text_lines', '_text_words', 'other']
+
     def __init__(self, src, fmt_ordered = fmt_ordered_default, 
                             fmt_labeled = fmt_labeled_default, 
                             fieldsep = utils.fieldsep):
@@ -346,23 +559,18 @@ class Card:
         self.parsed = True
         self.valid = True # only records broken pt right now (broken as in, no /)
         # default values for all fields
-        self.__dict__[field_name] = ''
-        self.__dict__[field_rarity] = ''
-        self.__dict__[field_cost] = Manacost('')
-        self.__dict__[field_supertypes] = []
-        self.__dict__[field_types] = []
-        self.__dict__[field_subtypes] = []
-        self.__dict__[field_loyalty] = ''
-        self.__dict__[field_loyalty + '_value'] = None
-        self.__dict__[field_pt] = ''
-        self.__dict__[field_pt + '_p'] = None
-        self.__dict__[field_pt + '_p_value'] = None
-        self.__dict__[field_pt + '_t'] = None
-        self.__dict__[field_pt + '_t_value'] = None
-        self.__dict__[field_text] = Manatext('')
-        self.__dict__[field_text + '_lines'] = []
-        self.__dict__[field_text + '_words'] = []
-        self.__dict__[field_other] = []
+        self.name = ''
+        self.rarity = ''
+        self.cost = intern_manacost('')
+        self.supertypes = []
+        self.types = []
+        self.subtypes = []
+        self.loyalty = ''
+        self.pt = ''
+        self.pt_p = None
+        self.pt_t = None
+        self.text = Manatext('')
+        self.other = []
         self.bside = None
         # format-independent view of processed input
         self.fields = None # will be reset later
@@ -374,7 +582,11 @@ class Card:
                                   fmt_ordered = fmt_ordered,
                                   fmt_labeled = fmt_labeled,
                                   fieldsep = fieldsep)
-            p_success, v_success, parsed_fields = fields_from_json(src)
+            # cached corpora come with the fields already parsed
+            if utils.json_field_fields in src:
+                p_success, v_success, parsed_fields = src[utils.json_field_fields]
+            else:
+                p_success, v_success, parsed_fields = fields_from_json(src)
             self.parsed = p_success
             self.valid = v_success
             self.fields = parsed_fields
@@ -400,7 +612,7 @@ class Card:
                 if hasattr(self, '_set_' + field):
                     getattr(self, '_set_' + field)(self.fields[field])
                 # otherwise use the default one
-                elif field in self.__dict__:
+                elif field in fieldnames:
                     self.set_field_default(field, self.fields[field])
                 # If we don't recognize the field, fail. This is a totally artificial
                 # limitation; if we just used the default handler for the else case,
@@ -425,132 +637,160 @@ class Card:
         for idx, value in values:
             if first:
                 first = False
-                self.__dict__[field] = value
+                setattr(self, field, value)
             else:
                 # stick it in other so we'll be know about it when we format the card
                 self.valid = False
-                self.__dict__[field_other] += [(idx, '<' + field + '> ' + str(value))]
+                self.other += [(idx, '<' + field + '> ' + str(value))]
 
     def _set_loyalty(self, values):
         first = True
         for idx, value in values:
             if first:
                 first = False
-                self.__dict__[field_loyalty] = value
-                try:
-                    self.__dict__[field_loyalty + '_value'] = int(value)
-                except ValueError:
-                    self.__dict__[field_loyalty + '_value'] = None
-                    # Technically '*' could still be valid, but it's unlikely...
+                self.loyalty = value
             else:
                 self.valid = False
-                self.__dict__[field_other] += [(idx, '<loyalty> ' + str(value))]
+                self.other += [(idx, '<loyalty> ' + str(value))]
 
     def _set_pt(self, values):
         first = True
         for idx, value in values:
             if first:
                 first = False
-                self.__dict__[field_pt] = value
+                self.pt = value
                 p_t = value.split('/') # hardcoded
                 if len(p_t) == 2:
-                    self.__dict__[field_pt + '_p'] = p_t[0]
-                    try:
-                        self.__dict__[field_pt + '_p_value'] = int(p_t[0])
-                    except ValueError:
-                        self.__dict__[field_pt + '_p_value'] = None
-                    self.__dict__[field_pt + '_t'] = p_t[1]
-                    try:
-                        self.__dict__[field_pt + '_t_value'] = int(p_t[1])
-                    except ValueError:
-                        self.__dict__[field_pt + '_t_value'] = None
+                    self.pt_p = p_t[0]
+                    self.pt_t = p_t[1]
                 else:
                     self.valid = False
             else:
                 self.valid = False
-                self.__dict__[field_other] += [(idx, '<pt> ' + str(value))]
+                self.other += [(idx, '<pt> ' + str(value))]
     
     def _set_text(self, values):
         first = True
         for idx, value in values:
             if first:
                 first = False
-                mtext = value
-                self.__dict__[field_text] = mtext
-                fulltext = mtext.encode()
-                if fulltext:
-                    self.__dict__[field_text + '_lines'] = map(Manatext, 
-                                                               fulltext.split(utils.newline))
-                    self.__dict__[field_text + '_words'] = re.sub(utils.unletters_regex, 
-                                                                  ' ', 
-                                                                  fulltext).split()
+                self.text = value
             else:
                 self.valid = False
-                self.__dict__[field_other] += [(idx, '<text> ' + str(value))]
+                self.other += [(idx, '<text> ' + str(value))]
         
     def _set_other(self, values):
         # just record these, we could do somthing unset valid if we really wanted
         for idx, value in values:
-            self.__dict__[field_other] += [(idx, value)]
+            self.other += [(idx, value)]
+
+    # Derived views of the fields. Hardly anything uses these, and encoding never
+    # does, so they aren't built until someone asks, and then they're kept.
+    # Assigning to them replaces the kept value.
+
+    @property
+    def text_lines(self):
+        try:
+            return self._text_lines
+        except AttributeError:
+            fulltext = self.text.encode()
+            if fulltext:
+                self._text_lines = map(Manatext, fulltext.split(utils.newline))
+            else:
+                self._text_lines = []
+            return self._text_lines
+
+    @text_lines.setter
+    def text_lines(self, value):
+        self._text_lines = value
+
+    @property
+    def text_words(self):
+        try:
+            return self._text_words
+        except AttributeError:
+            fulltext = self.text.encode()
+            if fulltext:
+                self._text_words = re.sub(utils.unletters_regex, ' ', fulltext).split()
+            else:
+                self._text_words = []
+            return self._text_words
+
+    @text_words.setter
+    def text_words(self, value):
+        self._text_words = value
+
+    # Technically '*' could still be a valid loyalty, but it's unlikely...
+    @property
+    def loyalty_value(self):
+        try:
+            return self._loyalty_value
+        except AttributeError:
+            self._loyalty_value = int_value(self.loyalty)
+            return self._loyalty_value
+
+    @loyalty_value.setter
+    def loyalty_value(self, value):
+        self._loyalty_value = value
+
+    @property
+    def pt_p_value(self):
+        try:
+            return self._pt_p_value
+        except AttributeError:
+            self._pt_p_value = int_value(self.pt_p)
+            return self._pt_p_value
+
+    @pt_p_value.setter
+    def pt_p_value(self, value):
+        self._pt_p_value = value
+
+    @property
+    def pt_t_value(self):
+        try:
+            return self._pt_t_value
+        except AttributeError:
+            self._pt_t_value = int_value(self.pt_t)
+            return self._pt_t_value
+
+    @pt_t_value.setter
+    def pt_t_value(self, value):
+        self._pt_t_value = value
+
+    # Without an instance dict, pickling needs to be told what the state is.
+    # Only the slots that have been set are saved, so any views that haven't been
+    # built yet stay that way.
+
+    def __getstate__(self):
+        return dict((slot, getattr(self, slot)) for slot in self.__slots__
+                    if hasattr(self, slot))
+
+    def __setstate__(self, state):
+        for slot in state:
+            setattr(self, slot, state[slot])
 
     # Output functions that produce various formats. encode() is specific to
     # the NN representation, use str() or format() for output intended for human
     # readers.
 
+    # Pass in a plan from compile_plan() or EncodePlan() to skip the options
+    # entirely; otherwise one is looked up for them.
+
     def encode(self, fmt_ordered = fmt_ordered_default,
                fmt_labeled = None, fieldsep = utils.fieldsep,
                randomize_fields = False, randomize_mana = False,
-               initial_sep = True, final_sep = True):
-        outfields = []
-
-        for field in fmt_ordered:
-            if field in self.__dict__:
-                outfield = self.__dict__[field]
-                if outfield:
-                    # specialized field handling for the ones that aren't strings (sigh)
-                    if isinstance(outfield, list):
-                        outfield_str = ' '.join(outfield)
-                    elif isinstance(outfield, Manacost):
-                        outfield_str = outfield.encode(randomize = randomize_mana)
-                    elif isinstance(outfield, Manatext):
-                        outfield_str = outfield.encode(randomize = randomize_mana)
-                    else:
-                        outfield_str = outfield
-                else:
-                    outfield_str = ''
-
-                if fmt_labeled and field in fmt_labeled:
-                        outfield_str = fmt_labeled[field] + outfield_str
-
-                outfields += [outfield_str]
-
-            else:
-                raise ValueError('unknown field for Card.encode(): ' + str(field))
-
-        if randomize_fields:
-            random.shuffle(outfields)
-        if initial_sep:
-            outfields = [''] + outfields
-        if final_sep:
-            outfields = outfields + ['']
-        
-        outstr = fieldsep.join(outfields)
-
-        if self.bside:
-            outstr = (outstr + utils.bsidesep 
-                      + self.bside.encode(fmt_ordered = fmt_ordered,
-                                          fmt_labeled = fmt_labeled,
-                                          fieldsep = fieldsep,
-                                          randomize_fields = randomize_fields, 
-                                          randomize_mana = randomize_mana,
-                                          initial_sep = initial_sep, final_sep = final_sep))
-
-        return outstr
+               initial_sep = True, final_sep = True, plan = None):
+        if plan is None:
+            plan = compile_plan(fmt_ordered, fmt_labeled, fieldsep,
+                                randomize_fields, randomize_mana, initial_sep, final_sep)
+        out = []
+        plan.emit(self, out)
+        return ''.join(out)
 
     def format(self, gatherer = False, for_forum = False, for_mse = False):
         outstr = ''
         if gatherer:
-            cardname = titlecase(self.__dict__[field_name])
+            cardname = titlecase(self.name)
             if not cardname:
                 cardname = '_NONAME_'
             if for_forum:
@@ -559,13 +799,13 @@ class Card:
             if for_forum:
                 outstr += '[/b]'
 
-            outstr += ' ' + self.__dict__[field_cost].format(for_forum = for_forum)
+            outstr += ' ' + self.cost.format(for_forum = for_forum)
 
-            if self.__dict__[field_rarity]:
-                if self.__dict__[field_rarity] in utils.json_rarity_unmap:
-                    rarity = utils.json_rarity_unmap[self.__dict__[field_rarity]]
+            if self.rarity:
+                if self.rarity in utils.json_rarity_unmap:
+                    rarity = utils.json_rarity_unmap[self.rarity]
                 else:
-                    rarity = self.__dict__[field_rarity]
+                    rarity = self.rarity
                 outstr += ' (' + rarity + ')'
 
             if not self.parsed:
@@ -575,26 +815,26 @@ class Card:
                 
             outstr += '\n'
 
-            basetypes = map(str.capitalize, self.__dict__[field_types])
+            basetypes = map(str.capitalize, self.types)
             if len(basetypes) < 1:
                 basetypes = ['_NOTYPE_']
             
-            outstr += ' '.join(map(str.capitalize, self.__dict__[field_supertypes]) + basetypes)
+            outstr += ' '.join(map(str.capitalize, self.supertypes) + basetypes)
 
-            if self.__dict__[field_subtypes]:
+            if self.subtypes:
                 outstr += (' ' + utils.dash_marker + ' ' + 
-                           ' '.join(self.__dict__[field_subtypes]).title())
+                           ' '.join(self.subtypes).title())
 
-            if self.__dict__[field_pt]:
-                outstr += ' (' + utils.from_unary(self.__dict__[field_pt]) + ')'
+            if self.pt:
+                outstr += ' (' + utils.from_unary(self.pt) + ')'
 
-            if self.__dict__[field_loyalty]:
-                outstr += ' ((' + utils.from_unary(self.__dict__[field_loyalty]) + '))'
+            if self.loyalty:
+                outstr += ' ((' + utils.from_unary(self.loyalty) + '))'
 
             outstr += '\n'
 
-            if self.__dict__[field_text].text:
-                mtext = self.__dict__[field_text].text
+            if self.text.text:
+                mtext = self.text.text
                 mtext = transforms.text_unpass_1_choice(mtext, delimit = False)
                 mtext = transforms.text_unpass_2_counters(mtext)
                 mtext = transforms.text_unpass_3_unary(mtext)
@@ -604,18 +844,18 @@ class Card:
                 mtext = transforms.text_unpass_6_newlines(mtext)
                 newtext = Manatext('')
                 newtext.text = mtext
-                newtext.costs = self.__dict__[field_text].costs
+                newtext.costs = self.text.costs
                 outstr += newtext.format(for_forum = for_forum)
             
                 outstr += '\n'
 
-            if self.__dict__[field_other]:
+            if self.other:
                 if for_forum:
                     outstr += '[i]'
                 else:
                     outstr += utils.dash_marker * 2
                     outstr += '\n'
-                for idx, value in self.__dict__[field_other]:
+                for idx, value in self.other:
                     outstr += '<' + str(idx) + '> ' + str(value)
                     outstr += '\n'
                 if for_forum:
@@ -624,13 +864,13 @@ class Card:
                     outstr += '\n'
 
         elif for_forum:
-            cardname = self.__dict__[field_name]
+            cardname = self.name
             outstr += cardname
-            if self.__dict__[field_rarity]:
-                if self.__dict__[field_rarity] in utils.json_rarity_unmap:
-                    rarity = utils.json_rarity_unmap[self.__dict__[field_rarity]]
+            if self.rarity:
+                if self.rarity in utils.json_rarity_unmap:
+                    rarity = utils.json_rarity_unmap[self.rarity]
                 else:
-                    rarity = self.__dict__[field_rarity]
+                    rarity = self.rarity
                 outstr += ' (' + rarity.lower() + ')'
             if not self.parsed:
                 outstr += ' _UNPARSED_'
@@ -638,16 +878,16 @@ class Card:
                 outstr += ' _INVALID_'
             outstr += '\n'
             
-            outstr += self.__dict__[field_cost].format(for_forum = for_forum)
+            outstr += self.cost.format(for_forum = for_forum)
             outstr += '\n'
 
-            outstr += ' '.join(self.__dict__[field_supertypes] + self.__dict__[field_types])
-            if self.__dict__[field_subtypes]:
-                outstr += ' ' + utils.dash_marker + ' ' + ' '.join(self.__dict__[field_subtypes])
+            outstr += ' '.join(self.supertypes + self.types)
+            if self.subtypes:
+                outstr += ' ' + utils.dash_marker + ' ' + ' '.join(self.subtypes)
             outstr += '\n'
             
-            if self.__dict__[field_text].text:
-                mtext = self.__dict__[field_text].text
+            if self.text.text:
+                mtext = self.text.text
                 mtext = transforms.text_unpass_1_choice(mtext, delimit = True)
                 #mtext = transforms.text_unpass_2_counters(mtext)
                 mtext = transforms.text_unpass_3_unary(mtext)
@@ -656,21 +896,21 @@ class Card:
                 mtext = transforms.text_unpass_6_newlines(mtext)
                 newtext = Manatext('')
                 newtext.text = mtext
-                newtext.costs = self.__dict__[field_text].costs
+                newtext.costs = self.text.costs
                 outstr += newtext.format(for_forum = for_forum) + '\n'
 
-            if self.__dict__[field_pt]:
-                outstr += '(' + utils.from_unary(self.__dict__[field_pt]) + ')'
+            if self.pt:
+                outstr += '(' + utils.from_unary(self.pt) + ')'
                 outstr += '\n'
 
-            if self.__dict__[field_loyalty]:
-                outstr += '((' + utils.from_unary(self.__dict__[field_loyalty]) + '))'
+            if self.loyalty:
+                outstr += '((' + utils.from_unary(self.loyalty) + '))'
                 outstr += '\n'
                 
-            if self.__dict__[field_other]:
+            if self.other:
                 outstr += utils.dash_marker * 2
                 outstr += '\n'
-                for idx, value in self.__dict__[field_other]:
+                for idx, value in self.other:
                     outstr += '<' + str(idx) + '> ' + str(value)
                     outstr += '\n'
 
@@ -678,31 +918,31 @@ class Card:
         elif for_mse:
             # need a 'card' string first
             outstr += 'card:\n'
-            cardname = titlecase(self.__dict__[field_name])
+            cardname = titlecase(self.name)
             outstr += '\tname: ' + cardname + '\n'
-            if self.__dict__[field_rarity]:
-                if self.__dict__[field_rarity] in utils.json_rarity_unmap:
-                    rarity = utils.json_rarity_unmap[self.__dict__[field_rarity]]
+            if self.rarity:
+                if self.rarity in utils.json_rarity_unmap:
+                    rarity = utils.json_rarity_unmap[self.rarity]
                 else:
-                    rarity = self.__dict__[field_rarity]
+                    rarity = self.rarity
                 outstr += '\trarity: ' + rarity.lower() + '\n'
             #if not self.parsed:
             #    outstr += ' _UNPARSED_'
             #if not self.valid:
             #    outstr += ' _INVALID_'
             
-            if "land" not in self.__dict__[field_types]:            
-                outstr += '\tcasting cost: ' + self.__dict__[field_cost].format(for_forum = for_forum).replace('{','').replace('}','')
+            if "land" not in self.types:            
+                outstr += '\tcasting cost: ' + self.cost.format(for_forum = for_forum).replace('{','').replace('}','')
                 outstr += '\n'
 
-            outstr += '\tsuper type: ' + ' '.join(self.__dict__[field_supertypes] + self.__dict__[field_types]).title() + '\n'
-            #outstr += 'sub type: ' + ' '.join(self.__dict__[field_types])
-            if self.__dict__[field_subtypes]:
-                outstr += '\tsub type: ' + ' '.join(self.__dict__[field_subtypes]).title()
+            outstr += '\tsuper type: ' + ' '.join(self.supertypes + self.types).title() + '\n'
+            #outstr += 'sub type: ' + ' '.join(self.types)
+            if self.subtypes:
+                outstr += '\tsub type: ' + ' '.join(self.subtypes).title()
                 outstr += '\n'
             
-            if self.__dict__[field_text].text:
-                mtext = self.__dict__[field_text].text
+            if self.text.text:
+                mtext = self.text.text
                 mtext = transforms.text_unpass_1_choice(mtext, delimit = False)
                 mtext = transforms.text_unpass_2_counters(mtext)
                 mtext = transforms.text_unpass_3_unary(mtext)
@@ -711,7 +951,7 @@ class Card:
                 mtext = transforms.text_unpass_6_newlines(mtext)
                 newtext = Manatext('')
                 newtext.text = mtext
-                newtext.costs = self.__dict__[field_text].costs
+                newtext.costs = self.text.costs
                 newtext = newtext.format(for_forum = for_forum)
                 newtext = newtext.replace(utils.this_marker, cardname) # first let's put the cardname where all the @s are.
                 newtext = newtext.replace(utils.counter_rename + ".", "countered.") # then replace any 'uncast' at the end of a sentence with 'countered'.
@@ -731,7 +971,7 @@ class Card:
                         newlineIndices.append(i + 1)
 
                 # need to do Special Things if it's a planeswalker.
-                if "planeswalker" in str(self.__dict__[field_types]): # for some reason this is in types, not supertypes...
+                if "planeswalker" in str(self.types): # for some reason this is in types, not supertypes...
                     outstr += '\tstylesheet: m15-planeswalker\n' # set the proper card style for a 3-line walker.
 
                     # set up the loyalty cost fields using regex to find how many there are.
@@ -744,8 +984,8 @@ class Card:
 
                     newtext = uppercaseNewLineAndFullstop(newtext) # we need to uppercase again; previous uppercase call didn't work due to loyalty costs being there.
 
-                    if self.__dict__[field_loyalty]:
-                        outstr += '\tloyalty: ' + utils.from_unary(self.__dict__[field_loyalty]) + '\n'
+                    if self.loyalty:
+                        outstr += '\tloyalty: ' + utils.from_unary(self.loyalty) + '\n'
 
                 # have to do special snowflake stuff for rule text with more than 1 line. 2 or more lines need to be double-indented...                
                 if linecount == 1:
@@ -756,8 +996,8 @@ class Card:
 
                 # also uncast still exists at this point? weird. should be 'unpassed' apparently. until then, did a manual replace.
 
-            if self.__dict__[field_pt]:
-                ptstring = utils.from_unary(self.__dict__[field_pt]).split('/')
+            if self.pt:
+                ptstring = utils.from_unary(self.pt).split('/')
                 if (len(ptstring) > 1): #really don't want to be accessing anything nonexistent.
                     outstr += '\tpower: ' + ptstring[0] + '\n'
                     outstr += '\ttoughness: ' + ptstring[1] + '\n'
@@ -779,30 +1019,30 @@ class Card:
         rd = ')'
         outstr = ''
 
-        if self.__dict__[field_rarity]:
-            outstr += ld + self.__dict__[field_rarity] + rd + ' '
+        if self.rarity:
+            outstr += ld + self.rarity + rd + ' '
 
-        coststr = self.__dict__[field_cost].vectorize(delimit = True)
+        coststr = self.cost.vectorize(delimit = True)
         if coststr:
             outstr += coststr + ' '
 
         typestr = ' '.join(map(lambda s: '(' + s + ')',
-                               self.__dict__[field_supertypes] + self.__dict__[field_types]))
+                               self.supertypes + self.types))
         if typestr:
             outstr += typestr + ' '
 
-        if self.__dict__[field_subtypes]:
-            outstr += ' '.join(self.__dict__[field_subtypes]) + ' '
+        if self.subtypes:
+            outstr += ' '.join(self.subtypes) + ' '
 
-        if self.__dict__[field_pt]:
+        if self.pt:
             outstr += ' '.join(map(lambda s: '(' + s + ')',
-                                   self.__dict__[field_pt].replace('/', '/ /').split()))
+                                   self.pt.replace('/', '/ /').split()))
             outstr += ' '
         
-        if self.__dict__[field_loyalty]:
-            outstr += '((' + self.__dict__[field_loyalty] + ')) '
+        if self.loyalty:
+            outstr += '((' + self.loyalty + ')) '
             
-        outstr += self.__dict__[field_text].vectorize()
+        outstr += self.text.vectorize()
 
         if self.bside:
             outstr = '_ASIDE_ ' + outstr + '\n\n_BSIDE_ ' + self.bside.vectorize()
@@ -8,9 +8,11 @@ import subprocess
 import os
 import struct
 import math
+import cPickle as pickle
 import utils
 import cardlib
 import transforms
+import jdecode
 
 # # this would be nice, but doing it naively makes things worse
 # from joblib import Parallel, delayed
@@ -19,64 +21,146 @@ import transforms
 libdir = os.path.dirname(os.path.realpath(__file__))
 datadir = os.path.realpath(os.path.join(libdir, '../data'))
 
+# Bump this if the layout of the card vector store changes.
+store_version = 1
+
 # # multithreading control parameters
 # cores = multiprocessing.cpu_count()
 # segments = cores / 2 if cores / 2 > 0 else 1
 
-# max length of vocabulary entries
-max_w = 50
-
+# Pull the vocabulary out of a word2vec binary file, along with the offset of each
+# word's vector. The words are stored inline between the vectors, so this is the one
+# part we have to walk through a word at a time.
+def parse_vector_file(data):
+    header_end = data.index('\n')
+    words, size = map(int, data[:header_end].split())
+    vocab = []
+    offsets = []
+    pos = header_end + 1
+    for b in range(0, words):
+        end = data.index(' ', pos)
+        # each vector is followed by a newline, which belongs to nobody
+        vocab.append(data[pos:end].lstrip('\n'))
+        offsets.append(end + 1)
+        pos = end + 1 + 4 * size
+    return vocab, offsets, size
 
-#### snip! ####
+# Map each word to its row in the vector matrix. If a word somehow shows up twice,
+# the first one wins, same as vocab.index() would give.
+def make_vocab_index(vocab):
+    vocab_index = {}
+    for i, word in enumerate(vocab):
+        vocab_index.setdefault(word, i)
+    return vocab_index
 
-def read_vector_file(fname):
-    with open(fname, 'rb') as f:
-        words = int(f.read(4))
-        size = int(f.read(4))
-        vocab = [' '] * (words * max_w)
-        M = []
-        for b in range(0,words):
-            a = 0
-            while True:
-                c = f.read(1)
-                vocab[b * max_w + a] = c;
-                if len(c) == 0 or c == ' ':
-                    break
-                if (a < max_w) and vocab[b * max_w + a] != '\n':
-                    a += 1
-            tmp = list(struct.unpack('f'*size,f.read(4 * size)))
-            length = math.sqrt(sum([tmp[i] * tmp[i] for i in range(0,len(tmp))]))
-            for i in range(0,len(tmp)):
-                tmp[i] /= length
-            M.append(tmp)
-        return ((''.join(vocab)).split(),M)
-
-def makevector(vocabulary,vecs,sequence):
-    words = sequence.split()
+# Rows for the words in a sequence. Words we don't have vectors for are tallied
+# in missing, if it's given, instead of just disappearing.
+def lookup_words(vocab_index, sequence, missing = None):
     indices = []
-    for word in words:
-        if word not in vocabulary:
-            #print("Missing word in vocabulary: " + word)
-            continue
-            #return [0.0]*len(vecs[0])
-        indices.append(vocabulary.index(word))
-    #res = map(sum,[vecs[i] for i in indices])
-    res = None
-    for v in [vecs[i] for i in indices]:
-        if res == None:
-            res = v
-        else:
-            res = [x + y for x, y in zip(res,v)]
-    length = math.sqrt(sum([res[i] * res[i] for i in range(0,len(res))]))
-    for i in range(0,len(res)):
-        res[i] /= length
-    return res
+    for word in sequence.split():
+        if word in vocab_index:
+            indices.append(vocab_index[word])
+        elif missing is not None:
+            missing[word] = missing.get(word, 0) + 1
+    return indices
+
+# The precomputed card vectors live next to the vector model they were built from.
+def store_names(vector_fname):
+    return vector_fname + '.cards.npy', vector_fname + '.cards.idx'
 
-#### !snip ####
+# The store has to be rebuilt if the vector model, the cards, or the code that turns
+# the cards into word sequences changes.
+def store_key(vector_fname, card_fname):
+    return (store_version, jdecode.file_hash(vector_fname), jdecode.file_hash(card_fname),
+            jdecode.cache_stamp())
 
 
 try:
     import numpy
+
+    def read_vector_file(fname):
+        with open(fname, 'rb') as f:
+            data = f.read()
+        vocab, offsets, size = parse_vector_file(data)
+
+        # copy each vector straight out of the file into its row
+        M = numpy.empty((len(offsets), size), dtype = numpy.float32)
+        for i, offset in enumerate(offsets):
+            M[i] = numpy.frombuffer(data, numpy.float32, size, offset)
+
+        lengths = numpy.sqrt((M * M).sum(axis = 1))
+        lengths[lengths == 0] = 1
+        M /= lengths[:, numpy.newaxis]
+        return (vocab, M)
+
+    def makevector(vocab_index, vecs, sequence, missing = None):
+        res = vecs[lookup_words(vocab_index, sequence, missing)].sum(axis = 0)
+        length = numpy.sqrt(numpy.dot(res, res))
+        # nothing we recognized, so leave it as all zeros
+        if length > 0:
+            res /= length
+        return res
+
+    def stack_vectors(vecs, size):
+        return numpy.array(vecs, dtype = numpy.float32).reshape(len(vecs), size)
+
+    # All of the vectors are normalized, so cosine similarity is just a dot product,
+    # and we can score every query against every card with one matrix product. For
+    # each query, we return (score, card index) for its n best cards, plus anything
+    # tied with the last of them so that the caller can break ties consistently.
+    def top_similar(cardvecs, queries, n):
+        scores = numpy.dot(stack_vectors(queries, cardvecs.shape[1]), cardvecs.T)
+        k = min(n, scores.shape[1])
+        if k <= 0:
+            return [[] for q in queries]
+        best = numpy.argpartition(-scores, k - 1, axis = 1)[:, :k]
+        results = []
+        for row, cols in zip(scores, best):
+            threshold = row[cols].min()
+            # a card against itself can come out a rounding error over 1 in float32,
+            # where working out the cosine from scratch always gave exactly 1.0
+            results += [[(min(float(row[i]), 1.0), i)
+                         for i in numpy.flatnonzero(row >= threshold)]]
+        return results
+
+    # Load the card vectors saved by save_card_store, if they're still good. The matrix
+    # is mapped read only rather than read in, so any number of processes can share
+    # the same copy of it in the page cache.
+    def load_card_store(vector_fname, key):
+        npy_fname, idx_fname = store_names(vector_fname)
+        try:
+            with open(idx_fname, 'rb') as f:
+                if pickle.load(f) != key:
+                    return None
+                cardnames, missing = pickle.load(f)
+            cardvecs = numpy.load(npy_fname, mmap_mode = 'r')
+        # a stale or truncated store just gets rebuilt
+        except (IOError, EOFError, ValueError, AttributeError, ImportError,
+                pickle.UnpicklingError):
+            return None
+        if len(cardvecs) != len(cardnames):
+            return None
+        return cardnames, cardvecs, missing
+
+    def save_card_store(vector_fname, key, cardnames, cardvecs, missing):
+        npy_fname, idx_fname = store_names(vector_fname)
+        # write to temporary files first so that nobody ever sees half a store; the
+        # index goes last, since it has the key that says the matrix is good
+        suffix = '.' + str(os.getpid())
+        try:
+            with open(npy_fname + suffix, 'wb') as f:
+                numpy.save(f, cardvecs)
+            with open(idx_fname + suffix, 'wb') as f:
+                pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump((cardnames, missing), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(npy_fname + suffix, npy_fname)
+            os.rename(idx_fname + suffix, idx_fname)
+        except (IOError, OSError):
+            # not being able to save it just means building it again next time
+            for fname in [npy_fname + suffix, idx_fname + suffix]:
+                if os.path.exists(fname):
+                    os.remove(fname)
+
     def cosine_similarity(v1,v2):
         A = numpy.array([v1,v2])
 
@@ -105,6 +189,34 @@ try:
         return cosine[0][1]
 
 except ImportError:
+    def read_vector_file(fname):
+        with open(fname, 'rb') as f:
+            data = f.read()
+        vocab, offsets, size = parse_vector_file(data)
+
+        vector_struct = struct.Struct('f' * size)
+        M = []
+        for offset in offsets:
+            tmp = vector_struct.unpack_from(data, offset)
+            length = math.sqrt(sum([x * x for x in tmp]))
+            M.append([x / length for x in tmp])
+        return (vocab, M)
+
+    #### snip! ####
+
+    def makevector(vocab_index, vecs, sequence, missing = None):
+        indices = lookup_words(vocab_index, sequence, missing)
+        res = [0.0] * len(vecs[0])
+        for v in [vecs[i] for i in indices]:
+            res = [x + y for x, y in zip(res,v)]
+        length = math.sqrt(sum([res[i] * res[i] for i in range(0,len(res))]))
+        if length > 0:
+            for i in range(0,len(res)):
+                res[i] /= length
+        return res
+
+    #### !snip ####
+
     def cosine_similarity(v1,v2):
         #compute cosine similarity of v1 to v2: (v1 dot v1)/{||v1||*||v2||)
         sumxx, sumxy, sumyy = 0, 0, 0
@@ -115,15 +227,80 @@ except ImportError:
             sumxy += x*y
         return sumxy/math.sqrt(sumxx*sumyy)
 
+    def stack_vectors(vecs, size):
+        return vecs
+
+    # without numpy there's nothing to map, so the card vectors are always rebuilt
+    def load_card_store(vector_fname, key):
+        return None
+
+    def save_card_store(vector_fname, key, cardnames, cardvecs, missing):
+        pass
+
+    def top_similar(cardvecs, queries, n):
+        return [[(cosine_similarity(q, v), i) for i, v in enumerate(cardvecs)]
+                for q in queries]
+
 def cosine_similarity_name(cardvec, v, name):
     return (cosine_similarity(cardvec, v), name)
 
+# Build the vector for every card in an encoded card file, returning the names and
+# the stacked vectors in file order.
+def make_card_vectors(vocab_index, vecs, card_fname, missing = None):
+    cardnames = []
+    cardvecs = []
+    with open(card_fname, 'rt') as f:
+        for card_src in utils.stream_cards(f):
+            card = cardlib.Card(card_src)
+            cardnames += [card.name]
+            cardvecs += [makevector(vocab_index, vecs, card.vectorize(), missing)]
+    # one row per card, in the same order as the names
+    return cardnames, stack_vectors(cardvecs, len(vecs[0]))
+
+# The build step for the card vector store: compute all of the card vectors and save
+# them next to the vector model, unless what's there is already up to date. Returns
+# the names, the vectors, and the words that weren't in the vocabulary.
+def build_card_store(vocab_index, vecs, vector_fname, card_fname, verbose = False):
+    key = store_key(vector_fname, card_fname)
+    store = load_card_store(vector_fname, key)
+    if store is not None:
+        if verbose:
+            print '  Mapped precomputed card vectors from: ' + store_names(vector_fname)[0]
+        return store
+
+    if verbose:
+        print '  Reading encoded cards from: ' + card_fname
+        print '  They\'d better be in the same order as the file used to build the vector model!'
+    missing = {}
+    cardnames, cardvecs = make_card_vectors(vocab_index, vecs, card_fname, missing)
+    save_card_store(vector_fname, key, cardnames, cardvecs, missing)
+    return cardnames, cardvecs, missing
+
+
+# The word sequences to look up for a card: one for each side, unless there's nothing
+# there at all.
+def card_queries(card):
+    if isinstance(card, cardlib.Card):
+        words = card.vectorize().split('\n\n')[0]
+    else:
+        # assume it's a string (that's already a vector)
+        words = card
+
+    if not words:
+        return []
+
+    queries = [words]
+    if isinstance(card, cardlib.Card) and card.bside:
+        queries += card_queries(card.bside)
+    return queries
+
 
 class CBOW:
     def __init__(self, verbose = True,
                  vector_fname = os.path.join(datadir, 'cbow.bin'), 
                  card_fname = os.path.join(datadir, 'output.txt')):
         self.verbose = verbose
+        self.cardnames = []
         self.cardvecs = []
 
         if self.verbose:
@@ -133,20 +310,12 @@ class CBOW:
             print '  Reading binary vector data from: ' + vector_fname
         (vocab, vecs) = read_vector_file(vector_fname)
         self.vocab = vocab
+        self.vocab_index = make_vocab_index(vocab)
         self.vecs = vecs
-        
-        if self.verbose:
-            print '  Reading encoded cards from: ' + card_fname
-            print '  They\'d better be in the same order as the file used to build the vector model!'
-        with open(card_fname, 'rt') as f:
-            text = f.read()
-        for card_src in text.split(utils.cardsep):
-            if card_src:
-                card = cardlib.Card(card_src)
-                name = card.name
-                self.cardvecs += [(name, makevector(self.vocab, 
-                                                    self.vecs, 
-                                                    card.vectorize()))]
+
+        # self.missing holds the out of vocabulary words we've seen, with counts
+        (self.cardnames, self.cardvecs, self.missing) = build_card_store(
+            self.vocab_index, self.vecs, vector_fname, card_fname, verbose = self.verbose)
 
         # self.par = Parallel(n_jobs=segments)
                 
@@ -155,27 +324,27 @@ class CBOW:
             print '  vocab size: ' + str(len(self.vocab))
             print '  raw vecs:   ' + str(len(self.vecs))
             print '  card vecs:  ' + str(len(self.cardvecs))
+            if self.missing:
+                print ('  missing:    ' + str(sum(self.missing.values())) + ' words ('
+                       + str(len(self.missing)) + ' unique) not in vocab')
 
     def nearest(self, card, n=5):
-        if isinstance(card, cardlib.Card):
-            words = card.vectorize().split('\n\n')[0]
-        else:
-            # assume it's a string (that's already a vector)
-            words = card
-            
-        if not words:
-            return []
-
-        cardvec = makevector(self.vocab, self.vecs, words)
-
-        comparisons = [cosine_similarity_name(cardvec, v, name) for (name, v) in self.cardvecs]
-        # comparisons = self.par(delayed(cosine_similarity_name)(cardvec, v, name) 
-        #                        for (name, v) in self.cardvecs)
-
-        comparisons.sort(reverse = True)
-        comp_n = comparisons[:n]
-        
-        if isinstance(card, cardlib.Card) and card.bside:
-            comp_n += self.nearest(card.bside)
+        return self.nearest_batch([card], n)[0]
+
+    # Same as nearest() for each of the cards, but scoring all of them at once.
+    def nearest_batch(self, cards, n=5):
+        queries = []
+        owners = []
+        for i, card in enumerate(cards):
+            for words in card_queries(card):
+                queries += [makevector(self.vocab_index, self.vecs, words, self.missing)]
+                owners += [i]
 
-        return comp_n
+        results = [[] for card in cards]
+        if queries:
+            for i, candidates in zip(owners, top_similar(self.cardvecs, queries, n)):
+                comparisons = [(score, self.cardnames[j]) for score, j in candidates]
+                comparisons.sort(reverse = True)
+                # bsides' matches get tacked on after the aside's
+                results[i] += comparisons[:n]
+        return results
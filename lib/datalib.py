@@ -1,7 +1,19 @@
 import re
+import os
+import array
+import bisect
+import heapq
+import shlex
+import operator
+import mmap
+import struct
+import hashlib
+import multiprocessing
+import cPickle as pickle
 
 import utils
-from cardlib import Card
+import jdecode
+from cardlib import Card, int_value
 
 # Format a list of rows of data into nice columns.
 # Note that it's the columns that are nice, not this code.
@@ -27,17 +39,6 @@ def printrows(l):
     for row in l:
         print row
 
-# index management helpers
-def index_size(d):
-    return sum(map(lambda k: len(d[k]), d))
-
-def inc(d, k, obj):
-    if k or k == 0:
-        if k in d:
-            d[k] += obj
-        else:
-            d[k] = obj
-
 # thanks gleemax
 def plimit(s, mlen = 1000):
     if len(s) > mlen:
@@ -45,105 +46,648 @@ def plimit(s, mlen = 1000):
     else:
         return s
 
-class Datamine:
-    # build the global indices
-    def __init__(self, card_srcs):
-        # global card pools
-        self.unparsed_cards = []
-        self.invalid_cards = []
-        self.cards = []
-        self.allcards = []
-        
-        # global indices
-        self.by_name = {}
-        self.by_type = {}
-        self.by_type_inclusive = {}
-        self.by_supertype = {}
-        self.by_supertype_inclusive = {}
-        self.by_subtype = {}
-        self.by_subtype_inclusive = {}
-        self.by_color = {}
-        self.by_color_inclusive = {}
-        self.by_color_count = {}
-        self.by_cmc = {}
-        self.by_cost = {}
-        self.by_power = {}
-        self.by_toughness = {}
-        self.by_pt = {}
-        self.by_loyalty = {}
-        self.by_textlines = {}
-        self.by_textlen = {}
-
-        self.indices = {
-            'by_name' : self.by_name,
-            'by_type' : self.by_type,
-            'by_type_inclusive' : self.by_type_inclusive,
-            'by_supertype' : self.by_supertype,
-            'by_supertype_inclusive' : self.by_supertype_inclusive,
-            'by_subtype' : self.by_subtype,
-            'by_subtype_inclusive' : self.by_subtype_inclusive,
-            'by_color' : self.by_color,
-            'by_color_inclusive' : self.by_color_inclusive,
-            'by_color_count' : self.by_color_count,
-            'by_cmc' : self.by_cmc,
-            'by_cost' : self.by_cost,
-            'by_power' : self.by_power,
-            'by_toughness' : self.by_toughness,
-            'by_pt' : self.by_pt,
-            'by_loyalty' : self.by_loyalty,
-            'by_textlines' : self.by_textlines,
-            'by_textlen' : self.by_textlen,
-        }
+# The card table keeps everything in the standard library's growable arrays, so
+# adding a card is cheap and a column of a million cards is a few megabytes. Tables
+# loaded from an index file have read only numpy arrays (or plain arrays without
+# numpy) mapped from the file instead, which are swapped for growable ones if we
+# ever add to them. Anything that looks at a whole column goes through the helpers
+# below, which use numpy when it's there.
+
+# what a numeric column holds for a card that doesn't have a number there
+missing_value = -(1 << 31)
+
+# bits of the colors column
+color_bits = {
+    utils.mana_W : 1,
+    utils.mana_U : 2,
+    utils.mana_B : 4,
+    utils.mana_R : 8,
+    utils.mana_G : 16,
+}
+
+def growable(col, typecode):
+    if isinstance(col, array.array):
+        return col
+    return array.array(typecode, col.tostring())
+
+try:
+    import numpy
+
+    # A numpy array over the same memory as col. Don't hang on to it: the column
+    # can move when it grows.
+    def column_view(col):
+        if isinstance(col, numpy.ndarray):
+            return col
+        if len(col) == 0:
+            return numpy.zeros(0, dtype = numpy.dtype(col.typecode))
+        return numpy.frombuffer(col, dtype = numpy.dtype(col.typecode))
+
+    # read count values of the given type straight out of buf at offset
+    def column_from_buffer(buf, typecode, offset, count):
+        return numpy.frombuffer(buf, dtype = numpy.dtype(typecode), count = count,
+                                offset = offset)
+
+    # how many times each of the codes 0 to n - 1 appears
+    def column_counts(codes, n):
+        return numpy.bincount(column_view(codes), minlength = n).tolist()
+
+    # positions in col that hold value
+    def column_equal(col, value):
+        return numpy.flatnonzero(column_view(col) == value)
+
+    # positions of the n largest counts, largest first, ties in their original order
+    def column_rank(counts, n):
+        return numpy.argsort(-numpy.array(counts, dtype = numpy.int64),
+                             kind = 'mergesort')[:n].tolist()
+
+    # position of the first of the largest values, ignoring missing ones
+    def column_argmax(values):
+        values = column_view(values)
+        if len(values) == 0 or values.max() == missing_value:
+            return None
+        return int(values.argmax())
+
+    # smallest and largest values, ignoring missing ones
+    def column_range(values):
+        values = column_view(values)
+        values = values[values != missing_value]
+        if len(values) == 0:
+            return None, None
+        return int(values.min()), int(values.max())
+
+    # Sort (id, code) pairs into postings lists: the ids for code c, in the order
+    # they were added, are ids_by_code[starts[c]:starts[c + 1]].
+    def column_group(ids, codes, n):
+        codes = column_view(codes)
+        order = numpy.argsort(codes, kind = 'mergesort')
+        starts = numpy.zeros(n + 1, dtype = numpy.dtype('l'))
+        numpy.cumsum(numpy.bincount(codes, minlength = n), out = starts[1:])
+        return column_view(ids)[order].astype(numpy.dtype('i')), starts
+
+    # the code of each pair, given the starts of its postings lists
+    def column_ungroup(starts):
+        starts = column_view(starts)
+        return numpy.repeat(numpy.arange(len(starts) - 1, dtype = numpy.dtype('i')),
+                            numpy.diff(starts))
+
+    def column_diff(starts):
+        return numpy.diff(column_view(starts)).tolist()
+
+    # col + base, as a growable column
+    def column_shift(col, base, typecode):
+        shifted = column_view(col).astype(numpy.dtype(typecode)) + base
+        return array.array(typecode, shifted.tostring())
+
+    # remap[code] for each code in codes, as a growable column
+    def column_remap(codes, remap):
+        remap = numpy.array(remap, dtype = numpy.dtype('i'))
+        return array.array('i', remap[column_view(codes)].tostring())
+
+except ImportError:
+    def column_from_buffer(buf, typecode, offset, count):
+        col = array.array(typecode)
+        col.fromstring(buf[offset:offset + count * col.itemsize])
+        return col
+
+    def column_counts(codes, n):
+        counts = [0] * n
+        for code in codes:
+            counts[code] += 1
+        return counts
+
+    def column_equal(col, value):
+        return [i for i, v in enumerate(col) if v == value]
+
+    def column_rank(counts, n):
+        return sorted(range(len(counts)), key = lambda i: counts[i], reverse = True)[:n]
+
+    def column_argmax(values):
+        best = None
+        for i, value in enumerate(values):
+            if value != missing_value and (best is None or value > values[best]):
+                best = i
+        return best
+
+    def column_range(values):
+        values = [value for value in values if value != missing_value]
+        if len(values) == 0:
+            return None, None
+        return min(values), max(values)
+
+    def column_group(ids, codes, n):
+        order = sorted(range(len(codes)), key = lambda i: codes[i])
+        starts = array.array('l', [0] * (n + 1))
+        for code in codes:
+            starts[code + 1] += 1
+        for c in range(n):
+            starts[c + 1] += starts[c]
+        return array.array('i', [ids[i] for i in order]), starts
+
+    def column_ungroup(starts):
+        codes = array.array('i')
+        for c in range(len(starts) - 1):
+            codes.extend([c] * (starts[c + 1] - starts[c]))
+        return codes
+
+    def column_diff(starts):
+        return [starts[c + 1] - starts[c] for c in range(len(starts) - 1)]
+
+    def column_shift(col, base, typecode):
+        return array.array(typecode, [v + base for v in col])
+
+    def column_remap(codes, remap):
+        return array.array('i', [remap[c] for c in codes])
+
+# One of the Datamine indices, dictionary encoded. Every distinct key gets a code,
+# in the order the keys were first seen, and the index itself is a list of
+# (card id, code) pairs, so a card can have any number of keys in it, or none.
+# The pairs are sorted into postings lists when someone needs those; an index
+# loaded from a file only has the postings lists until it's added to.
+class KeyColumn:
+    def __init__(self, vocab = None, firsts = None, grouped = None):
+        self.vocab = vocab if vocab is not None else []
+        self.codes = dict((key, code) for code, key in enumerate(self.vocab))
+        # the first card seen with each key
+        self.firsts = firsts if firsts is not None else array.array('i')
+        # postings lists, as (ids_by_code, starts) from column_group
+        self.grouped = grouped
+        if grouped is None:
+            self.ids = array.array('i')
+            self.keycodes = array.array('i')
+        else:
+            self.ids = None
+            self.keycodes = None
+
+    # The old dict indices skipped empty keys, but not 0, so we do too.
+    def add(self, card_id, key):
+        if key or key == 0:
+            if self.ids is None:
+                self.ungroup()
+            code = self.codes.get(key)
+            if code is None:
+                code = len(self.vocab)
+                self.codes[key] = code
+                self.vocab += [key]
+                self.firsts.append(card_id)
+            self.ids.append(card_id)
+            self.keycodes.append(code)
+            self.grouped = None
+
+    def group(self):
+        if self.grouped is None:
+            self.grouped = column_group(self.ids, self.keycodes, len(self.vocab))
+        return self.grouped
+
+    def ungroup(self):
+        ids_by_code, starts = self.grouped
+        self.ids = growable(ids_by_code, 'i')
+        self.keycodes = growable(column_ungroup(starts), 'i')
+        self.firsts = growable(self.firsts, 'i')
+
+    # the (card id, code) pairs, in whichever order we have them
+    def pairs(self):
+        if self.ids is None:
+            ids_by_code, starts = self.grouped
+            return ids_by_code, column_ungroup(starts)
+        return self.ids, self.keycodes
+
+    # Add the pairs of another index, with its card ids moved up by base. Keys we
+    # haven't seen get codes in the order other first saw them, so if other's cards
+    # all come after ours, this is the index we'd have got by adding them here.
+    def merge(self, other, base):
+        if self.ids is None:
+            self.ungroup()
+        remap = []
+        for key, first in zip(other.vocab, other.firsts):
+            code = self.codes.get(key)
+            if code is None:
+                code = len(self.vocab)
+                self.codes[key] = code
+                self.vocab += [key]
+                self.firsts.append(int(first) + base)
+            remap += [code]
+        ids, keycodes = other.pairs()
+        self.ids.extend(column_shift(ids, base, 'i'))
+        self.keycodes.extend(column_remap(keycodes, remap))
+        self.grouped = None
+
+    # number of distinct keys
+    def __len__(self):
+        return len(self.vocab)
+
+    def __contains__(self, key):
+        return key in self.codes
+
+    # total number of (card, key) pairs
+    def size(self):
+        if self.ids is None:
+            return len(self.grouped[0])
+        return len(self.ids)
+
+    # The reports have always listed keys in the order a plain dict built up one
+    # card at a time would have them, ties included, so that's the order here.
+    def keys(self):
+        return dict.fromkeys(self.vocab).keys()
+
+    def first(self, key):
+        return int(self.firsts[self.codes[key]])
+
+    # ids of the cards with key, in increasing order
+    def postings(self, key):
+        if not key in self.codes:
+            return array.array('i')
+        code = self.codes[key]
+        ids_by_code, starts = self.group()
+        return ids_by_code[starts[code]:starts[code + 1]]
+
+    # how many cards have each key, by code
+    def counts(self):
+        if self.grouped is not None:
+            return column_diff(self.grouped[1])
+        return column_counts(self.keycodes, len(self.vocab))
+
+    # (key, count) for every key, in the order of keys()
+    def histogram(self):
+        counts = self.counts()
+        return [(key, counts[self.codes[key]]) for key in self.keys()]
+
+    # (key, count) for the n most common keys
+    def ranked(self, n):
+        hist = self.histogram()
+        return [hist[i] for i in column_rank([count for key, count in hist], n)]
+
+# Names of the Datamine indices, in the order they've always been listed in.
+index_names = [
+    'by_name',
+    'by_type',
+    'by_type_inclusive',
+    'by_supertype',
+    'by_supertype_inclusive',
+    'by_subtype',
+    'by_subtype_inclusive',
+    'by_color',
+    'by_color_inclusive',
+    'by_color_count',
+    'by_cmc',
+    'by_cost',
+    'by_power',
+    'by_toughness',
+    'by_pt',
+    'by_loyalty',
+    'by_textlines',
+    'by_textlen',
+]
+
+# Numeric columns, one value per card. valid is 1 or 0.
+value_names = [
+    'cmc',
+    'colors',
+    'power',
+    'toughness',
+    'loyalty',
+    'textlen',
+    'textlines',
+    'valid',
+]
+
+# the number in a unary field like power, or missing_value
+def unary_value(s):
+    if not s:
+        return missing_value
+    value = int_value(utils.from_unary(s))
+    if value is None or not missing_value < value < -missing_value:
+        return missing_value
+    return value
+
+class CardTable:
+    '''columns of values and keys for a set of parsed cards'''
+
+    def __init__(self, nrows = 0, values = None, keys = None):
+        self.nrows = nrows
+        if values is None:
+            values = dict((name, array.array('i')) for name in value_names)
+        if keys is None:
+            keys = dict((name, KeyColumn()) for name in index_names)
+        self.values = values
+        self.keys = keys
+
+    def __len__(self):
+        return self.nrows
+
+    # Add a row for a parsed card, and return its id.
+    def append(self, card):
+        card_id = self.nrows
+        values = self.values
+        keys = self.keys
+        if not isinstance(values['cmc'], array.array):
+            for name in value_names:
+                values[name] = growable(values[name], 'i')
+
+        colors = card.cost.colors
+        colorbits = 0
+        for c in colors:
+            colorbits |= color_bits.get(c, 0)
+        text = card.text.encode()
+        if text:
+            textlines = text.count(utils.newline) + 1
+        else:
+            textlines = 0
+
+        values['cmc'].append(card.cost.cmc)
+        values['colors'].append(colorbits)
+        values['power'].append(unary_value(card.pt_p))
+        values['toughness'].append(unary_value(card.pt_t))
+        values['loyalty'].append(unary_value(card.loyalty))
+        values['textlen'].append(len(text))
+        values['textlines'].append(textlines)
+        values['valid'].append(1 if card.valid else 0)
+
+        keys['by_name'].add(card_id, card.name)
+        keys['by_type'].add(card_id, ' '.join(card.types))
+        for t in card.types:
+            keys['by_type_inclusive'].add(card_id, t)
+        keys['by_supertype'].add(card_id, ' '.join(card.supertypes))
+        for t in card.supertypes:
+            keys['by_supertype_inclusive'].add(card_id, t)
+        keys['by_subtype'].add(card_id, ' '.join(card.subtypes))
+        for t in card.subtypes:
+            keys['by_subtype_inclusive'].add(card_id, t)
+
+        if colors:
+            keys['by_color'].add(card_id, colors)
+            for c in colors:
+                keys['by_color_inclusive'].add(card_id, c)
+            keys['by_color_count'].add(card_id, len(colors))
+        else:
+            # colorless, still want to include in these tables
+            keys['by_color'].add(card_id, 'A')
+            keys['by_color_inclusive'].add(card_id, 'A')
+            keys['by_color_count'].add(card_id, 0)
+
+        keys['by_cmc'].add(card_id, card.cost.cmc)
+        cost = card.cost.encode()
+        keys['by_cost'].add(card_id, cost if cost else 'none')
+
+        keys['by_power'].add(card_id, card.pt_p)
+        keys['by_toughness'].add(card_id, card.pt_t)
+        keys['by_pt'].add(card_id, card.pt)
+
+        keys['by_loyalty'].add(card_id, card.loyalty)
+
+        keys['by_textlines'].add(card_id, textlines)
+        keys['by_textlen'].add(card_id, len(text))
+
+        self.nrows += 1
+        return card_id
+
+    # id of the first card with the largest value in a numeric column
+    def argmax(self, name):
+        return column_argmax(self.values[name])
+
+    # Add the rows of another table after ours; its card ids move up by our length.
+    def merge(self, other):
+        base = self.nrows
+        for name in value_names:
+            self.values[name] = growable(self.values[name], 'i')
+            self.values[name].extend(growable(other.values[name], 'i'))
+        for name in index_names:
+            self.keys[name].merge(other.keys[name], base)
+        self.nrows += other.nrows
+
+    # (smallest, largest) value in a numeric column
+    def range(self, name):
+        return column_range(self.values[name])
+
+# A sequence of cards that are only looked up, by id, when they're asked for.
+class CardList:
+    def __init__(self, lookup, ids):
+        self.lookup = lookup
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.lookup(int(self.ids[i]))
+
+    def __iter__(self):
+        for card_id in self.ids:
+            yield self.lookup(int(card_id))
+
+# Where each card in a file starts, and the card itself, for the cards between the
+# offsets start and end (or the end of the file).
+def file_cards(fname, start = 0, end = None):
+    with open(fname, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if end is None or end > size:
+            end = size
+        if end <= start:
+            return
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            pos = start
+            while pos < end:
+                nxt = data.find(utils.cardsep, pos, end)
+                if nxt < 0:
+                    nxt = end
+                yield pos, data[pos:nxt]
+                pos = nxt + len(utils.cardsep)
+        finally:
+            data.close()
 
+# The start of a card separator at or after start that overlaps the one at pos
+# (like the first two of three newlines do the last two), or -1 if there isn't
+# one. Reading from start splits the file at every separator nothing overlaps,
+# but not necessarily at the ones something does.
+def overlapping_sep(data, pos, start = 0):
+    seplen = len(utils.cardsep)
+    return data.find(utils.cardsep, max(pos - seplen + 1, start), pos + seplen - 1)
+
+# The offset just past the first card separator in the last run of them at or
+# after start, which is as far as there are complete cards; a card after that might
+# still be being written. Reading the whole file splits there too, so reading up to
+# here now and the rest later gives the same cards. If there is no separator after
+# start, that's just start.
+def complete_end(fname, start = 0):
+    with open(fname, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() <= start:
+            return start
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            last = data.rfind(utils.cardsep, start)
+            if last >= 0:
+                prev = overlapping_sep(data, last, start)
+                while prev >= 0:
+                    last = prev
+                    prev = overlapping_sep(data, last, start)
+        finally:
+            data.close()
+    if last < 0:
+        return start
+    return last + len(utils.cardsep)
+
+class Datamine(object):
+    # Build the global indices, either from a list of card sources, or from the
+    # encoded card file named by source. Cards from a list are kept around; cards
+    # from a file aren't, we just remember where they were and parse them again if
+    # anyone asks for them. With start and end, only that part of the file is read;
+    # update() reads the rest later, and merge() puts pieces back together.
+    def __init__(self, card_srcs = [], source = None, start = 0, end = None):
+        # global indices, which are the key columns of the card table; card ids
+        # are row numbers in the table, and positions in allcards
+        self.table = CardTable()
+        self.link_indices()
+
+        self.source = source
+        self.srcfile = None
+        # the part of the source we've read
+        self.start = start
+        self.end = start
+        # where each parsed and unparsed card is in the source, or -1 if it isn't
+        self.offsets = array.array('l')
+        self.lengths = array.array('i')
+        self.unparsed_offsets = array.array('l')
+        self.unparsed_lengths = array.array('i')
+        # and the cards that aren't, by card id or unparsed index
+        self.held_cards = {}
+        self.held_unparsed = {}
+
+        self.add_many(card_srcs)
+        if source is not None:
+            if end is None:
+                end = os.path.getsize(source)
+            self.update(end)
+
+    def link_indices(self):
+        self.indices = {}
+        for name in index_names:
+            self.indices[name] = self.table.keys[name]
+        self.by_name = self.indices['by_name']
+        self.by_type = self.indices['by_type']
+        self.by_type_inclusive = self.indices['by_type_inclusive']
+        self.by_supertype = self.indices['by_supertype']
+        self.by_supertype_inclusive = self.indices['by_supertype_inclusive']
+        self.by_subtype = self.indices['by_subtype']
+        self.by_subtype_inclusive = self.indices['by_subtype_inclusive']
+        self.by_color = self.indices['by_color']
+        self.by_color_inclusive = self.indices['by_color_inclusive']
+        self.by_color_count = self.indices['by_color_count']
+        self.by_cmc = self.indices['by_cmc']
+        self.by_cost = self.indices['by_cost']
+        self.by_power = self.indices['by_power']
+        self.by_toughness = self.indices['by_toughness']
+        self.by_pt = self.indices['by_pt']
+        self.by_loyalty = self.indices['by_loyalty']
+        self.by_textlines = self.indices['by_textlines']
+        self.by_textlen = self.indices['by_textlen']
+
+    # Add one more card to the indices. This only ever appends to the columns (and
+    # invalidates the grouped postings, which are rebuilt the next time somebody
+    # looks), so it's O(1) amortized however big the mine already is. Cards without
+    # an offset in the source are kept around.
+    def add(self, card_src, offset = None):
+        # the empty card is not interesting
+        if not card_src:
+            return
+        if not isinstance(self.offsets, array.array):
+            self.growable_spans()
+        card = Card(card_src)
+        if card.parsed:
+            card_id = self.table.append(card)
+            offsets, lengths, held = self.offsets, self.lengths, self.held_cards
+        else:
+            card_id = len(self.unparsed_offsets)
+            offsets, lengths, held = self.unparsed_offsets, self.unparsed_lengths, self.held_unparsed
+        if offset is None:
+            held[card_id] = card
+            offsets.append(-1)
+            lengths.append(0)
+        else:
+            offsets.append(offset)
+            lengths.append(len(card_src))
+
+    # columns mapped from an index file can't grow, so copy them first
+    def growable_spans(self):
+        self.offsets = growable(self.offsets, 'l')
+        self.lengths = growable(self.lengths, 'i')
+        self.unparsed_offsets = growable(self.unparsed_offsets, 'l')
+        self.unparsed_lengths = growable(self.unparsed_lengths, 'i')
+
+    def add_many(self, card_srcs):
         for card_src in card_srcs:
-            # the empty card is not interesting
-            if not card_src:
-                continue
-            card = Card(card_src)
-            if card.valid:
-                self.cards += [card]
-                self.allcards += [card]
-            elif card.parsed:
-                self.invalid_cards += [card]
-                self.allcards += [card]
-            else:
-                self.unparsed_cards += [card]
-
-            if card.parsed:
-                inc(self.by_name, card.name, [card])
-
-                inc(self.by_type, ' '.join(card.types), [card])
-                for t in card.types:
-                    inc(self.by_type_inclusive, t, [card])
-                inc(self.by_supertype, ' '.join(card.supertypes), [card])
-                for t in card.supertypes:
-                    inc(self.by_supertype_inclusive, t, [card])
-                inc(self.by_subtype, ' '.join(card.subtypes), [card])
-                for t in card.subtypes:
-                    inc(self.by_subtype_inclusive, t, [card])
-
-                if card.cost.colors:
-                    inc(self.by_color, card.cost.colors, [card])
-                    for c in card.cost.colors:
-                        inc(self.by_color_inclusive, c, [card])
-                    inc(self.by_color_count, len(card.cost.colors), [card])
-                else:
-                    # colorless, still want to include in these tables
-                    inc(self.by_color, 'A', [card])
-                    inc(self.by_color_inclusive, 'A', [card])
-                    inc(self.by_color_count, 0, [card])
-
-                inc(self.by_cmc, card.cost.cmc, [card])
-                inc(self.by_cost, card.cost.encode() if card.cost.encode() else 'none', [card])
-
-                inc(self.by_power, card.pt_p, [card])
-                inc(self.by_toughness, card.pt_t, [card])
-                inc(self.by_pt, card.pt, [card])
-
-                inc(self.by_loyalty, card.loyalty, [card])
-
-                inc(self.by_textlines, len(card.text_lines), [card])
-                inc(self.by_textlen, len(card.text.encode()), [card])
+            self.add(card_src)
+
+    # Read the cards added to the end of the source since we last looked, up to end,
+    # or up to the last complete card if end is None. Nothing before self.end is read
+    # again. Returns the number of cards added.
+    def update(self, end = None):
+        if end is None:
+            end = complete_end(self.source, self.end)
+        before = len(self.table) + len(self.unparsed_offsets)
+        for offset, card_src in file_cards(self.source, self.end, end):
+            self.add(card_src, offset)
+        self.end = max(self.end, end)
+        return len(self.table) + len(self.unparsed_offsets) - before
+
+    # Add all the cards of another Datamine after ours. Pieces of the same file have
+    # to be merged in order, each starting where the last one ended; then the result
+    # is exactly what reading the whole thing at once would have given.
+    def merge(self, other):
+        if other.source != self.source:
+            raise ValueError('can\'t merge indices of ' + repr(other.source)
+                             + ' into indices of ' + repr(self.source))
+        if self.source is not None and other.start != self.end:
+            raise ValueError('can\'t merge indices of ' + self.source + ' from byte '
+                             + str(other.start) + ' after reading up to byte '
+                             + str(self.end))
+        base = len(self.table)
+        unparsed_base = len(self.unparsed_offsets)
+        self.table.merge(other.table)
+        self.growable_spans()
+        self.offsets.extend(growable(other.offsets, 'l'))
+        self.lengths.extend(growable(other.lengths, 'i'))
+        self.unparsed_offsets.extend(growable(other.unparsed_offsets, 'l'))
+        self.unparsed_lengths.extend(growable(other.unparsed_lengths, 'i'))
+        for card_id, card in other.held_cards.iteritems():
+            self.held_cards[base + card_id] = card
+        for i, card in other.held_unparsed.iteritems():
+            self.held_unparsed[unparsed_base + i] = card
+        self.end = max(self.end, other.end)
+
+    def read_source(self, offset, length):
+        if self.srcfile is None:
+            self.srcfile = open(self.source, 'rb')
+        self.srcfile.seek(offset)
+        return self.srcfile.read(length)
+
+    def card(self, card_id):
+        if card_id in self.held_cards:
+            return self.held_cards[card_id]
+        return Card(self.read_source(self.offsets[card_id], self.lengths[card_id]))
+
+    def unparsed_card(self, i):
+        if i in self.held_unparsed:
+            return self.held_unparsed[i]
+        return Card(self.read_source(self.unparsed_offsets[i], self.unparsed_lengths[i]))
+
+    # global card pools
+    @property
+    def allcards(self):
+        return CardList(self.card, xrange(len(self.table)))
+
+    @property
+    def cards(self):
+        return CardList(self.card, column_equal(self.table.values['valid'], 1))
+
+    @property
+    def invalid_cards(self):
+        return CardList(self.card, column_equal(self.table.values['valid'], 0))
+
+    @property
+    def unparsed_cards(self):
+        return CardList(self.unparsed_card, xrange(len(self.unparsed_offsets)))
 
     # summarize the indices
     # Yes, this printing code is pretty terrible.
@@ -154,104 +698,86 @@ class Datamine:
         print '--------------------'
         print str(len(self.by_name)) + ' unique card names'
         print '--------------------'
-        print (str(len(self.by_color_inclusive)) + ' represented colors (including colorless as \'A\'), ' 
+        print (str(len(self.by_color_inclusive)) + ' represented colors (including colorless as \'A\'), '
                + str(len(self.by_color)) + ' combinations')
         print 'Breakdown by color:'
-        rows = [self.by_color_inclusive.keys()]
-        rows += [[len(self.by_color_inclusive[k]) for k in rows[0]]]
+        hist = self.by_color_inclusive.histogram()
+        rows = [[k for k, count in hist]]
+        rows += [[count for k, count in hist]]
         printrows(padrows(rows))
         print 'Breakdown by number of colors:'
-        rows = [self.by_color_count.keys()]
-        rows += [[len(self.by_color_count[k]) for k in rows[0]]]
+        hist = self.by_color_count.histogram()
+        rows = [[k for k, count in hist]]
+        rows += [[count for k, count in hist]]
         printrows(padrows(rows))
         print '--------------------'
         print str(len(self.by_type_inclusive)) + ' unique card types, ' + str(len(self.by_type)) + ' combinations'
         print 'Breakdown by type:'
-        d = sorted(self.by_type_inclusive, 
-                   lambda x,y: cmp(len(self.by_type_inclusive[x]), len(self.by_type_inclusive[y])), 
-                   reverse = True)
-        rows = [[k for k in d[:hsize]]]
-        rows += [[len(self.by_type_inclusive[k]) for k in rows[0]]]
+        hist = self.by_type_inclusive.ranked(hsize)
+        rows = [[k for k, count in hist]]
+        rows += [[count for k, count in hist]]
         printrows(padrows(rows))
         print '--------------------'
-        print (str(len(self.by_subtype_inclusive)) + ' unique subtypes, ' 
+        print (str(len(self.by_subtype_inclusive)) + ' unique subtypes, '
                + str(len(self.by_subtype)) + ' combinations')
         print '-- Popular subtypes: --'
-        d = sorted(self.by_subtype_inclusive, 
-                   lambda x,y: cmp(len(self.by_subtype_inclusive[x]), len(self.by_subtype_inclusive[y])), 
-                   reverse = True)
         rows = []
-        for k in d[0:vsize]:
-            rows += [[k, len(self.by_subtype_inclusive[k])]]
+        for k, count in self.by_subtype_inclusive.ranked(vsize):
+            rows += [[k, count]]
         printrows(padrows(rows))
         print '-- Top combinations: --'
-        d = sorted(self.by_subtype, 
-                   lambda x,y: cmp(len(self.by_subtype[x]), len(self.by_subtype[y])), 
-                   reverse = True)
         rows = []
-        for k in d[0:vsize]:
-            rows += [[k, len(self.by_subtype[k])]]
+        for k, count in self.by_subtype.ranked(vsize):
+            rows += [[k, count]]
         printrows(padrows(rows))
         print '--------------------'
-        print (str(len(self.by_supertype_inclusive)) + ' unique supertypes, ' 
+        print (str(len(self.by_supertype_inclusive)) + ' unique supertypes, '
                + str(len(self.by_supertype)) + ' combinations')
         print 'Breakdown by supertype:'
-        d = sorted(self.by_supertype_inclusive, 
-                   lambda x,y: cmp(len(self.by_supertype_inclusive[x]),len(self.by_supertype_inclusive[y])), 
-                   reverse = True)
-        rows = [[k for k in d[:hsize]]]
-        rows += [[len(self.by_supertype_inclusive[k]) for k in rows[0]]]
+        hist = self.by_supertype_inclusive.ranked(hsize)
+        rows = [[k for k, count in hist]]
+        rows += [[count for k, count in hist]]
         printrows(padrows(rows))
         print '--------------------'
         print str(len(self.by_cmc)) + ' different CMCs, ' + str(len(self.by_cost)) + ' unique mana costs'
         print 'Breakdown by CMC:'
-        d = sorted(self.by_cmc, reverse = False)
-        rows = [[k for k in d[:cmcsize]]]
-        rows += [[len(self.by_cmc[k]) for k in rows[0]]]
+        hist = sorted(self.by_cmc.histogram())[:cmcsize]
+        rows = [[k for k, count in hist]]
+        rows += [[count for k, count in hist]]
         printrows(padrows(rows))
         print '-- Popular mana costs: --'
-        d = sorted(self.by_cost, 
-                   lambda x,y: cmp(len(self.by_cost[x]), len(self.by_cost[y])), 
-                   reverse = True)
         rows = []
-        for k in d[0:vsize]:
-            rows += [[utils.from_mana(k), len(self.by_cost[k])]]
+        for k, count in self.by_cost.ranked(vsize):
+            rows += [[utils.from_mana(k), count]]
         printrows(padrows(rows))
         print '--------------------'
         print str(len(self.by_pt)) + ' unique p/t combinations'
         if len(self.by_power) > 0 and len(self.by_toughness) > 0:
-            print ('Largest power: ' + str(max(map(len, self.by_power)) - 1) + 
-                   ', largest toughness: ' + str(max(map(len, self.by_toughness)) - 1))
+            print ('Largest power: ' + str(max(map(len, self.by_power.vocab)) - 1) +
+                   ', largest toughness: ' + str(max(map(len, self.by_toughness.vocab)) - 1))
         print '-- Popular p/t values: --'
-        d = sorted(self.by_pt, 
-                   lambda x,y: cmp(len(self.by_pt[x]), len(self.by_pt[y])), 
-                   reverse = True)
         rows = []
-        for k in d[0:vsize]:
-            rows += [[utils.from_unary(k), len(self.by_pt[k])]]
+        for k, count in self.by_pt.ranked(vsize):
+            rows += [[utils.from_unary(k), count]]
         printrows(padrows(rows))
         print '--------------------'
         print 'Loyalty values:'
-        d = sorted(self.by_loyalty, 
-                   lambda x,y: cmp(len(self.by_loyalty[x]), len(self.by_loyalty[y])), 
-                   reverse = True)
         rows = []
-        for k in d[0:vsize]:
-            rows += [[utils.from_unary(k), len(self.by_loyalty[k])]]
+        for k, count in self.by_loyalty.ranked(vsize):
+            rows += [[utils.from_unary(k), count]]
         printrows(padrows(rows))
         print '--------------------'
         if len(self.by_textlen) > 0 and len(self.by_textlines) > 0:
-            print('Card text ranges from ' + str(min(self.by_textlen)) + ' to ' 
-                  + str(max(self.by_textlen)) + ' characters in length')
-            print('Card text ranges from ' + str(min(self.by_textlines)) + ' to '
-                  + str(max(self.by_textlines)) + ' lines')
+            minlen, maxlen = self.table.range('textlen')
+            minlines, maxlines = self.table.range('textlines')
+            print('Card text ranges from ' + str(minlen) + ' to '
+                  + str(maxlen) + ' characters in length')
+            print('Card text ranges from ' + str(minlines) + ' to '
+                  + str(maxlines) + ' lines')
         print '-- Line counts by frequency: --'
-        d = sorted(self.by_textlines, 
-                   lambda x,y: cmp(len(self.by_textlines[x]), len(self.by_textlines[y])), 
-                   reverse = True)
         rows = []
-        for k in d[0:vsize]:
-            rows += [[k, len(self.by_textlines[k])]]
+        for k, count in self.by_textlines.ranked(vsize):
+            rows += [[k, count]]
         printrows(padrows(rows))
         print '===================='
 
@@ -262,27 +788,20 @@ class Datamine:
         print 'Overview of indices:'
         rows = [['Index Name', 'Keys', 'Total Members']]
         for index in self.indices:
-            rows += [[index, len(self.indices[index]), index_size(self.indices[index])]]
+            rows += [[index, len(self.indices[index]), self.indices[index].size()]]
         printrows(padrows(rows))
         print '********************'
         if len(self.by_name) > 0:
-            scardname =  sorted(self.by_name, 
-                                lambda x,y: cmp(len(x), len(y)), 
-                                reverse = False)[0]
+            scardname = min(self.by_name.keys(), key = len)
             print 'Shortest Cardname: (' + str(len(scardname)) + ')'
             print '  ' + scardname
-            lcardname =  sorted(self.by_name, 
-                                lambda x,y: cmp(len(x), len(y)), 
-                                reverse = True)[0]
+            lcardname = max(self.by_name.keys(), key = len)
             print 'Longest Cardname: (' + str(len(lcardname)) + ')'
             print '  ' + lcardname
-            d = sorted(self.by_name, 
-                       lambda x,y: cmp(len(self.by_name[x]), len(self.by_name[y])), 
-                       reverse = True)
             rows = []
-            for k in d[0:vsize]:
-                if len(self.by_name[k]) > 1:
-                    rows += [[k, len(self.by_name[k])]]
+            for k, count in self.by_name.ranked(vsize):
+                if count > 1:
+                    rows += [[k, count]]
             if rows == []:
                 print('No duplicated cardnames')
             else:
@@ -292,75 +811,63 @@ class Datamine:
             print 'No cards indexed by name?'
         print '--------------------'
         if len(self.by_type) > 0:
-            ltypes = sorted(self.by_type, 
-                            lambda x,y: cmp(len(x), len(y)), 
-                            reverse = True)[0]
+            ltypes = max(self.by_type.keys(), key = len)
             print 'Longest card type: (' + str(len(ltypes)) + ')'
             print '  ' + ltypes
         else:
             print 'No cards indexed by type?'
         if len(self.by_subtype) > 0:
-            lsubtypes = sorted(self.by_subtype, 
-                               lambda x,y: cmp(len(x), len(y)), 
-                               reverse = True)[0]
+            lsubtypes = max(self.by_subtype.keys(), key = len)
             print 'Longest subtype: (' + str(len(lsubtypes)) + ')'
             print '  ' + lsubtypes
         else:
             print 'No cards indexed by subtype?'
         if len(self.by_supertype) > 0:
-            lsupertypes = sorted(self.by_supertype, 
-                            lambda x,y: cmp(len(x), len(y)), 
-                                 reverse = True)[0]
+            lsupertypes = max(self.by_supertype.keys(), key = len)
             print 'Longest supertype: (' + str(len(lsupertypes)) + ')'
             print '  ' + lsupertypes
         else:
             print 'No cards indexed by supertype?'
         print '--------------------'
         if len(self.by_cost) > 0:
-            lcost = sorted(self.by_cost, 
-                           lambda x,y: cmp(len(x), len(y)), 
-                           reverse = True)[0]
+            lcost = max(self.by_cost.keys(), key = len)
             print 'Longest mana cost: (' + str(len(lcost)) + ')'
             print '  ' + utils.from_mana(lcost)
-            print '\n' + plimit(self.by_cost[lcost][0].encode()) + '\n'
+            print '\n' + plimit(self.card(self.by_cost.first(lcost)).encode()) + '\n'
         else:
             print 'No cards indexed by cost?'
         if len(self.by_cmc) > 0:
-            lcmc = sorted(self.by_cmc, reverse = True)[0]
-            print 'Largest cmc: (' + str(lcmc) + ')'
-            print '  ' + str(self.by_cmc[lcmc][0].cost)
-            print '\n' + plimit(self.by_cmc[lcmc][0].encode())
+            card = self.card(self.table.argmax('cmc'))
+            print 'Largest cmc: (' + str(card.cost.cmc) + ')'
+            print '  ' + str(card.cost)
+            print '\n' + plimit(card.encode())
         else:
             print 'No cards indexed by cmc?'
         print '--------------------'
         if len(self.by_power) > 0:
-            lpower = sorted(self.by_power, 
-                            lambda x,y: cmp(len(x), len(y)), 
-                            reverse = True)[0]
+            lpower = max(self.by_power.keys(), key = len)
             print 'Largest creature power: ' + utils.from_unary(lpower)
-            print '\n' + plimit(self.by_power[lpower][0].encode()) + '\n'
-        else: 
+            print '\n' + plimit(self.card(self.by_power.first(lpower)).encode()) + '\n'
+        else:
             print 'No cards indexed by power?'
         if len(self.by_toughness) > 0:
-            ltoughness = sorted(self.by_toughness, 
-                            lambda x,y: cmp(len(x), len(y)), 
-                            reverse = True)[0]
+            ltoughness = max(self.by_toughness.keys(), key = len)
             print 'Largest creature toughness: ' + utils.from_unary(ltoughness)
-            print '\n' + plimit(self.by_toughness[ltoughness][0].encode())
-        else: 
+            print '\n' + plimit(self.card(self.by_toughness.first(ltoughness)).encode())
+        else:
             print 'No cards indexed by toughness?'
         print '--------------------'
         if len(self.by_textlines) > 0:
-            llines = sorted(self.by_textlines, reverse = True)[0]
-            print 'Most lines of text in a card: ' + str(llines)
-            print '\n' + plimit(self.by_textlines[llines][0].encode()) + '\n'
-        else: 
+            card_id = self.table.argmax('textlines')
+            print 'Most lines of text in a card: ' + str(self.table.values['textlines'][card_id])
+            print '\n' + plimit(self.card(card_id).encode()) + '\n'
+        else:
             print 'No cards indexed by line count?'
         if len(self.by_textlen) > 0:
-            ltext = sorted(self.by_textlen, reverse = True)[0]
-            print 'Most chars in a card text: ' + str(ltext)
-            print '\n' + plimit(self.by_textlen[ltext][0].encode())
-        else: 
+            card_id = self.table.argmax('textlen')
+            print 'Most chars in a card text: ' + str(self.table.values['textlen'][card_id])
+            print '\n' + plimit(self.card(card_id).encode())
+        else:
             print 'No cards indexed by char count?'
         print '--------------------'
         print 'There were ' + str(len(self.invalid_cards)) + ' invalid cards.'
@@ -377,3 +884,422 @@ class Datamine:
         elif len(self.unparsed_cards) > 0:
             print 'Not summarizing.'
         print '===================='
+
+    # A Query over these indices, from the query language if text is given,
+    # otherwise empty, to be built up with has() and where().
+    def query(self, text = None):
+        if text is None:
+            return Query(self)
+        return parse_query(self, text)
+
+# Queries pick out the cards with certain keys in the indices, and with numeric
+# values in some range. Every term has a sorted list of card ids it matches, and
+# we only walk the shortest one, checking each id against the other terms in order
+# of how many cards they match. Only the term we walk builds its list of ids; the
+# others just look ids up, in their postings or in a value column.
+
+comparisons = {
+    '<' : operator.lt,
+    '<=' : operator.le,
+    '=' : operator.eq,
+    '==' : operator.eq,
+    '!=' : operator.ne,
+    '>=' : operator.ge,
+    '>' : operator.gt,
+}
+
+# The key index with the same numbers as each value column, and how to get the
+# number out of one of its keys. Columns that aren't here are scanned.
+range_indices = {
+    'cmc' : ('by_cmc', int),
+    'power' : ('by_power', unary_value),
+    'toughness' : ('by_toughness', unary_value),
+    'loyalty' : ('by_loyalty', unary_value),
+    'textlen' : ('by_textlen', int),
+    'textlines' : ('by_textlines', int),
+}
+
+color_words = {
+    'white' : 'W',
+    'blue' : 'U',
+    'black' : 'B',
+    'red' : 'R',
+    'green' : 'G',
+    'colorless' : 'A',
+}
+
+# Cards with key in a key index. Since we only ever ask about increasing ids, each
+# check picks up the binary search where the last one left off. Looking at numpy
+# arrays one element at a time is slow, so a term that's going to do that many
+# times copies what it needs into a plain array first, which is cheap next to that.
+class KeyTerm:
+    def __init__(self, index, key):
+        self.postings = index.postings(key)
+
+    def size(self):
+        return len(self.postings)
+
+    def ids(self):
+        for card_id in self.postings:
+            yield int(card_id)
+
+    def matcher(self):
+        postings = growable(self.postings, 'i')
+        pos = [0]
+        def contains(card_id):
+            i = bisect.bisect_left(postings, card_id, pos[0])
+            pos[0] = i
+            return i < len(postings) and postings[i] == card_id
+        return contains
+
+# Cards whose value in a numeric column compares to value with op. Cards without a
+# value (no power, or a power of *) never match. If there's a key index with the
+# same numbers, the matching ids are the postings of the keys that match.
+class RangeTerm:
+    def __init__(self, table, name, op, value):
+        self.table = table
+        self.name = name
+        compare = comparisons[op]
+        self.test = lambda v: v != missing_value and compare(v, value)
+        # just which keys match, and how many cards have them; their postings are
+        # only needed if we end up walking this term
+        self.index = None
+        if name in range_indices:
+            index_name, key_value = range_indices[name]
+            self.index = table.keys[index_name]
+            counts = self.index.counts()
+            self.keys = [key for key in self.index.vocab if self.test(key_value(key))]
+            self.count = sum(counts[self.index.codes[key]] for key in self.keys)
+        else:
+            self.count = len(table)
+
+    def size(self):
+        return self.count
+
+    def ids(self):
+        if self.index is None:
+            test = self.test
+            for card_id, v in enumerate(growable(self.table.values[self.name], 'i')):
+                if test(v):
+                    yield card_id
+        else:
+            postings = [growable(self.index.postings(key), 'i') for key in self.keys]
+            for card_id in heapq.merge(*postings):
+                yield int(card_id)
+
+    def matcher(self):
+        column = growable(self.table.values[self.name], 'i')
+        test = self.test
+        return lambda card_id: test(column[card_id])
+
+def key_spellings(key):
+    spellings = [key]
+    if isinstance(key, basestring):
+        spellings += [key.lower(), key.upper()]
+        if key.lower() in color_words:
+            spellings += [color_words[key.lower()]]
+        if re.match(r'^-?[0-9]+$', key):
+            spellings += [int(key)]
+        spellings += [utils.to_unary(key.lower())]
+        if '{' in key:
+            spellings += [utils.to_mana(key.upper())]
+    return spellings
+
+class Query:
+    def __init__(self, mine):
+        self.mine = mine
+        self.terms = []
+
+    # The key index called name: by_name as it is, or type for by_type_inclusive
+    # (or by_type if there's no inclusive one).
+    def index_name(self, name):
+        for index_name in [name, 'by_' + name + '_inclusive', 'by_' + name]:
+            if index_name in self.mine.indices:
+                return index_name
+        raise ValueError('no index called ' + repr(name))
+
+    # Only cards with key in the index called name. The indices keep keys the way
+    # the cards are encoded, so we also try key the way that would be: lower case
+    # for names and types, upper case or spelled out for colors, numbers as ints
+    # or in unary, and mana costs encoded. A key no card has is most likely a
+    # mistake, so rather than quietly matching nothing, that's an error.
+    def has(self, name, key):
+        index_name = self.index_name(name)
+        index = self.mine.indices[index_name]
+        for spelling in key_spellings(key):
+            if spelling in index:
+                self.terms += [('has', index_name, spelling)]
+                return self
+        raise ValueError('no cards have ' + repr(key) + ' in ' + index_name)
+
+    # only cards whose value in the column called name compares to value with op
+    def where(self, name, op, value):
+        if not name in value_names:
+            raise ValueError('no numeric column called ' + repr(name))
+        if not op in comparisons:
+            raise ValueError('unknown comparison ' + repr(op))
+        self.terms += [('where', name, op, int(value))]
+        return self
+
+    # The terms for the indices as they are now, most selective first.
+    def plan(self):
+        table = self.mine.table
+        terms = []
+        for term in self.terms:
+            if term[0] == 'has':
+                terms += [KeyTerm(table.keys[term[1]], term[2])]
+            else:
+                terms += [RangeTerm(table, term[1], term[2], term[3])]
+        return sorted(terms, key = lambda term: term.size())
+
+    # ids of the matching cards, in increasing order, found as they're asked for
+    def ids(self):
+        terms = self.plan()
+        if not terms:
+            for card_id in xrange(len(self.mine.table)):
+                yield card_id
+            return
+        rest = [term.matcher() for term in terms[1:]]
+        for card_id in terms[0].ids():
+            for contains in rest:
+                if not contains(card_id):
+                    break
+            else:
+                yield card_id
+
+    def __iter__(self):
+        return self.ids()
+
+    def cards(self):
+        for card_id in self.ids():
+            yield self.mine.card(card_id)
+
+query_term = re.compile(r'^(\w+)(<=|>=|!=|==|<|>|=)(-?[0-9]+)$')
+
+# Parse a query like 'color:green type:creature cmc<=3 power>=4': every term has
+# to hold. name:key looks for key in an index, like has(), and keys with spaces in
+# them can be quoted; column<op>number compares a numeric column, like where().
+# An 'and' between terms is allowed, and ignored.
+def parse_query(mine, text):
+    query = Query(mine)
+    try:
+        words = shlex.split(text)
+    except ValueError as e:
+        raise ValueError('bad query ' + repr(text) + ': ' + str(e))
+    for word in words:
+        if word.lower() == 'and':
+            continue
+        match = query_term.match(word)
+        if match:
+            query.where(match.group(1), match.group(2), match.group(3))
+        elif ':' in word:
+            name, key = word.split(':', 1)
+            query.has(name, key)
+        else:
+            raise ValueError('bad query term ' + repr(word) + ' in ' + repr(text))
+    return query
+
+# Index files let us skip parsing a big card file again when nothing's changed.
+# They hold the card table, with each index as postings lists, and where every card
+# is in the source, but none of the cards themselves. The arrays are mapped straight
+# out of the file when it's loaded, so even a large one is ready almost at once.
+
+# Bump this if the layout of the index files changes.
+mine_version = 1
+
+# how much of the source to hash when checking an index file, and in how many pieces
+sample_count = 16
+sample_size = 1 << 16
+
+def mine_fname(fname):
+    return fname + '.datamine'
+
+# Hashing all of a multi gigabyte file would take longer than loading the index, so
+# we only hash evenly spaced pieces of it (which is all of it, for small files). The
+# size and modification time, to as fine a resolution as the filesystem keeps it,
+# catch nearly everything else; what gets through is a rewrite in place that keeps
+# the size and the timestamp and misses every piece.
+def sample_hash(fname):
+    h = hashlib.sha1()
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        for i in range(sample_count):
+            f.seek(max(size - sample_size, 0) * i / (sample_count - 1))
+            h.update(f.read(sample_size))
+    return h.hexdigest()
+
+def mine_key(fname):
+    st = os.stat(fname)
+    return [mine_version, st.st_size, st.st_mtime, sample_hash(fname),
+            jdecode.cache_stamp(), jdecode.file_hash(os.path.join(jdecode.libdir, 'datalib.py')),
+            array.array('l').itemsize]
+
+def column_typecode(col):
+    if isinstance(col, array.array):
+        return col.typecode
+    return col.dtype.char
+
+# every array in a Datamine read from a file, by name
+def mine_arrays(mine):
+    arrays = []
+    for name in value_names:
+        arrays += [('value.' + name, mine.table.values[name])]
+    for name in index_names:
+        index = mine.table.keys[name]
+        ids_by_code, starts = index.group()
+        arrays += [('key.' + name + '.firsts', index.firsts),
+                   ('key.' + name + '.ids', ids_by_code),
+                   ('key.' + name + '.starts', starts)]
+    arrays += [('offsets', mine.offsets),
+               ('lengths', mine.lengths),
+               ('unparsed_offsets', mine.unparsed_offsets),
+               ('unparsed_lengths', mine.unparsed_lengths)]
+    return arrays
+
+def padding(n):
+    return '\0' * (-n % 8)
+
+# The file is the length of the pickled part, then the key and a header describing
+# everything, pickled, then each array, all lined up on 8 byte boundaries.
+def save_mine(mine, mname, key):
+    header = {
+        'nrows' : len(mine.table),
+        'end' : mine.end,
+        'vocabs' : dict((name, mine.table.keys[name].vocab) for name in index_names),
+        'arrays' : [],
+    }
+    offset = 0
+    for name, col in mine_arrays(mine):
+        typecode = column_typecode(col)
+        header['arrays'] += [(name, typecode, offset, len(col))]
+        offset += len(col) * array.array(typecode).itemsize
+        offset += -offset % 8
+    pickled = pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
+    pickled += pickle.dumps(header, pickle.HIGHEST_PROTOCOL)
+    prefix = struct.pack('<Q', len(pickled)) + pickled
+
+    # write to a temporary file first so that nobody ever sees half an index
+    tmpname = mname + '.' + str(os.getpid())
+    try:
+        with open(tmpname, 'wb') as f:
+            f.write(prefix + padding(len(prefix)))
+            for name, col in mine_arrays(mine):
+                data = col.tostring()
+                f.write(data + padding(len(data)))
+        os.rename(tmpname, mname)
+    except (IOError, OSError):
+        # not being able to save it just means building it again next time
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+def load_mine(fname, mname, key):
+    if not os.path.isfile(mname):
+        return None
+    try:
+        with open(mname, 'rb') as f:
+            (length,) = struct.unpack('<Q', f.read(8))
+            if pickle.load(f) != key:
+                return None
+            header = pickle.load(f)
+            base = 8 + length
+            base += -base % 8
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        arrays = {}
+        for name, typecode, offset, count in header['arrays']:
+            arrays[name] = column_from_buffer(data, typecode, base + offset, count)
+    # a stale or truncated index is just rebuilt
+    except (IOError, EOFError, ValueError, KeyError, AttributeError, ImportError,
+            struct.error, pickle.UnpicklingError):
+        return None
+
+    values = dict((name, arrays['value.' + name]) for name in value_names)
+    keys = {}
+    for name in index_names:
+        keys[name] = KeyColumn(header['vocabs'][name], arrays['key.' + name + '.firsts'],
+                               (arrays['key.' + name + '.ids'],
+                                arrays['key.' + name + '.starts']))
+    mine = Datamine()
+    mine.source = fname
+    mine.table = CardTable(header['nrows'], values, keys)
+    mine.link_indices()
+    mine.offsets = arrays['offsets']
+    mine.lengths = arrays['lengths']
+    mine.unparsed_offsets = arrays['unparsed_offsets']
+    mine.unparsed_lengths = arrays['unparsed_lengths']
+    mine.end = header['end']
+    return mine
+
+# Split the first end bytes of fname into about n pieces that each start right after
+# a card separator. A separator that overlaps an earlier one (like the middle of
+# three newlines) might not be where reading the whole file would split it, so we
+# only split at separators that don't.
+def shard_bounds(fname, n, end = None):
+    with open(fname, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if end is None or end > size:
+            end = size
+        if end <= 0:
+            return []
+        bounds = [0]
+        seplen = len(utils.cardsep)
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            for i in range(1, n):
+                pos = max(end * i / n, bounds[-1])
+                while True:
+                    nxt = data.find(utils.cardsep, pos, end)
+                    if nxt < 0 or overlapping_sep(data, nxt) < 0:
+                        break
+                    pos = nxt + 1
+                if nxt < 0:
+                    break
+                if nxt + seplen > bounds[-1]:
+                    bounds += [nxt + seplen]
+        finally:
+            data.close()
+    if bounds[-1] < end:
+        bounds += [end]
+    return zip(bounds[:-1], bounds[1:])
+
+def mine_shard(args):
+    fname, start, end = args
+    return Datamine(source = fname, start = start, end = end)
+
+# A Datamine for the first end bytes of fname (or all of it), built in pieces by
+# jobs worker processes and merged back together in order.
+def build_mine(fname, jobs = 1, end = None):
+    bounds = shard_bounds(fname, jobs, end)
+    if jobs <= 1 or len(bounds) <= 1:
+        return Datamine(source = fname, end = end)
+    # merge into an empty mine rather than the first shard, whose dicts were put
+    # back together by the unpickler and don't iterate in the usual order
+    mine = Datamine(source = fname, end = 0)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for shard in pool.imap(mine_shard, [(fname, start, stop) for start, stop in bounds]):
+            mine.merge(shard)
+    finally:
+        pool.close()
+        pool.join()
+    return mine
+
+# A Datamine for an encoded card file. With cache = True, its indices are saved
+# next to the file, and used instead of reading the file again as long as neither
+# it nor the code that parses it has changed.
+def open_mine(fname, verbose = False, cache = True, jobs = 1):
+    if cache:
+        mname = mine_fname(fname)
+        key = mine_key(fname)
+        mine = load_mine(fname, mname, key)
+        if mine is not None:
+            if verbose:
+                print 'Loaded indices of ' + str(len(mine.table)) + ' cards from: ' + mname
+            return mine
+
+    mine = build_mine(fname, jobs)
+    if cache:
+        save_mine(mine, mname, key)
+        if verbose:
+            print 'Saved indices to: ' + mname
+    return mine
@@ -1,47 +1,136 @@
 import json
+import re
+import os
+import hashlib
+import marshal
+import gc
+import cPickle as pickle
 
 import config
+import utils
+import cardlib
 
-def mtg_open_json(fname, verbose = False):
+libdir = os.path.dirname(os.path.realpath(__file__))
 
-    with open(fname, 'r') as f:
-        jobj = json.load(f)
-    
-    allcards = {}
+# how much of the file to read at a time when streaming
+stream_chunk_size = 1 << 20
+
+# Bump this if the layout of the cache files changes.
+cache_version = 1
+# Editing any of these can change what fields_from_json produces, so they're
+# hashed into the key of every cache file.
+cache_sources = ['config.py', 'utils.py', 'transforms.py', 'manalib.py', 'cardlib.py',
+                 'jdecode.py']
+
+def json_stream_pairs(f, chunk_size = stream_chunk_size):
+    '''Incrementally decode the top level object of a json file, yielding its
+    (key, value) pairs one at a time so that only one value is ever held.'''
+
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    # The C decoder is much faster than anything we could do by hand, so we just
+    # ask it to decode the next item and read more input whenever it runs off the
+    # end of what we have. The reads grow with the buffer, so a value is never
+    # rescanned more than a few times.
+    def next_item(buf, pos, eof):
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf):
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                    # a number could have been cut off at the end of the buffer
+                    if end < len(buf) or eof:
+                        return obj, end, buf, eof
+                except ValueError:
+                    if eof:
+                        raise
+            elif eof:
+                raise ValueError('unexpected end of json input')
+            more = f.read(max(chunk_size, len(buf) - pos))
+            if not more:
+                eof = True
+            buf = buf[pos:] + more
+            pos = 0
+
+    def next_char(buf, pos, eof):
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf):
+                return buf[pos], pos + 1, buf, eof
+            elif eof:
+                raise ValueError('unexpected end of json input')
+            more = f.read(chunk_size)
+            if not more:
+                eof = True
+            buf = more
+            pos = 0
+
+    c, pos, buf, eof = next_char(buf, pos, eof)
+    if c != '{':
+        raise ValueError('expected a json object at the top level, got: ' + repr(c))
+    c, next_pos, buf, eof = next_char(buf, pos, eof)
+    if c == '}':
+        return
+    pos = next_pos - 1
+
+    while True:
+        key, pos, buf, eof = next_item(buf, pos, eof)
+        c, pos, buf, eof = next_char(buf, pos, eof)
+        if c != ':':
+            raise ValueError('expected \':\' in json object, got: ' + repr(c))
+        value, pos, buf, eof = next_item(buf, pos, eof)
+        # drop everything we've already decoded
+        buf = buf[pos:]
+        pos = 0
+        yield key, value
+
+        c, pos, buf, eof = next_char(buf, pos, eof)
+        if c == '}':
+            return
+        elif c != ',':
+            raise ValueError('expected \',\' or \'}\' in json object, got: ' + repr(c))
+
+# Group the cards of a single set by name, and link up any bsides. Split / flip / etc.
+# cards are numbered like 22a and 22b within the same set, so we can do this on the fly
+# without looking at anything else.
+def mtg_group_set(set):
+    setcards = {}
     asides = {}
     bsides = {}
 
-    for k_set in jobj:
-        set = jobj[k_set]
-        setname = set['name']
-        
-        for card in set['cards']:
-            card[config.json_field_set_name] = setname
-
-            cardnumber = None
-            if 'number' in card:
-                cardnumber = card['number']
-            # the lower avoids duplication of at least one card (Will-o/O'-the-Wisp)
-            cardname = card['name'].lower()
-
-            uid = set['code']
-            if cardnumber == None:
-                uid = uid + '_' + cardname + '_'
+    setname = set['name']
+    for card in set['cards']:
+        card[config.json_field_set_name] = setname
+
+        cardnumber = None
+        if 'number' in card:
+            cardnumber = card['number']
+        # the lower avoids duplication of at least one card (Will-o/O'-the-Wisp)
+        cardname = card['name'].lower()
+
+        uid = set['code']
+        if cardnumber == None:
+            uid = uid + '_' + cardname + '_'
+        else:
+            uid = uid + '_' + cardnumber
+
+        # aggregate by name to avoid duplicates, not counting bsides
+        if not uid[-1] == 'b':
+            if cardname in setcards:
+                setcards[cardname] += [card]
             else:
-                uid = uid + '_' + cardnumber
+                setcards[cardname] = [card]
 
-            # aggregate by name to avoid duplicates, not counting bsides
-            if not uid[-1] == 'b':
-                if cardname in allcards:
-                    allcards[cardname] += [card]
-                else:
-                    allcards[cardname] = [card]
-                    
-            # also aggregate aside cards by uid so we can add bsides later
-            if uid[-1:] == 'a':
-                asides[uid] = card
-            if uid[-1:] == 'b':
-                bsides[uid] = card
+        # also aggregate aside cards by uid so we can add bsides later
+        if uid[-1:] == 'a':
+            asides[uid] = card
+        if uid[-1:] == 'b':
+            bsides[uid] = card
 
     for uid in bsides:
         aside_uid = uid[:-1] + 'a'
@@ -56,6 +145,144 @@ def mtg_open_json(fname, verbose = False):
             #print aside_uid
             #print bsides[uid]
 
+    return setcards
+
+# Generator over the sets in the file, in file order, as (set code, {cardname : [cards]})
+# pairs. Only one set is ever decoded at a time.
+def mtg_stream_json(fname):
+    with open(fname, 'r') as f:
+        for k_set, set in json_stream_pairs(f):
+            yield k_set, mtg_group_set(set)
+
+def mtg_open_json(fname, verbose = False):
+    allcards = {}
+    for k_set, setcards in mtg_stream_json(fname):
+        for cardname in setcards:
+            if cardname in allcards:
+                allcards[cardname] += setcards[cardname]
+            else:
+                allcards[cardname] = setcards[cardname]
+
     if verbose:
         print 'Opened ' + str(len(allcards)) + ' uniquely named cards.'
     return allcards
+
+def exclude_sets(cardset):
+    return cardset == 'Unglued' or cardset == 'Unhinged' or cardset == 'Celebration'
+
+# The printing encode.py and decode.py look for, checked on the raw json so that
+# mtg_reduce_json can throw away the rest.
+def prefer_printing(jcard):
+    return not (jcard.get('rarity') == utils.json_rarity_unmap[utils.rarity_special_marker]
+                or exclude_sets(jcard[utils.json_field_set_name]))
+
+# What to call the cache files for a prefer() function: its name, for people, and a
+# hash of its code, so that editing it or passing a different function that happens
+# to have the same name gets a different cache. Whatever it calls isn't covered,
+# which for the functions in here is what having jdecode.py in cache_sources is for.
+def prefer_tag(prefer):
+    if prefer is None:
+        return 'first'
+    code = prefer.__code__
+    h = hashlib.sha1(marshal.dumps((code.co_code, code.co_consts, code.co_names)))
+    return re.sub(r'\W', '', prefer.__name__) + '.' + h.hexdigest()[:16]
+
+# Like mtg_open_json, but only hang on to the printings we might actually use:
+# the first one seen for each name, and the first one that prefer() accepts, if
+# that's a different one. Peak memory is then the largest set plus a card or two
+# per name, rather than the whole corpus.
+
+# With cache = True, the result is also saved next to the input with each card's
+# fields already parsed, and later runs load that instead as long as the input
+# and the code that parses it haven't changed. Different prefer() functions get
+# different cache files, as named by prefer_tag().
+def mtg_reduce_json(fname, prefer = None, verbose = False, cache = False):
+    if cache:
+        tag = prefer_tag(prefer)
+        cname = fname + '.' + tag + '.cache'
+        key = (cache_version, file_hash(fname), cache_stamp(), tag)
+        allcards = mtg_load_cache(cname, key)
+        if allcards is not None:
+            if verbose:
+                print 'Loaded ' + str(len(allcards)) + ' uniquely named cards from cache: ' + cname
+            return allcards
+
+    allcards = {}
+    preferred = set()
+    for k_set, setcards in mtg_stream_json(fname):
+        for cardname in setcards:
+            for card in setcards[cardname]:
+                if cardname in preferred:
+                    break
+                if prefer is None or prefer(card):
+                    preferred.add(cardname)
+                if cardname in allcards:
+                    if cardname in preferred:
+                        allcards[cardname] += [card]
+                else:
+                    allcards[cardname] = [card]
+
+    if verbose:
+        print 'Opened ' + str(len(allcards)) + ' uniquely named cards.'
+
+    if cache:
+        for cardname in allcards:
+            for card in allcards[cardname]:
+                mtg_parse_fields(card)
+        mtg_save_cache(cname, key, allcards)
+        if verbose:
+            print 'Saved parsed cards to cache: ' + cname
+    return allcards
+
+# cache management helpers
+def file_hash(fname):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(stream_chunk_size), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cache_stamp():
+    h = hashlib.sha1()
+    for src in cache_sources:
+        with open(os.path.join(libdir, src), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def mtg_parse_fields(card):
+    card[config.json_field_fields] = cardlib.fields_from_json(card)
+    if config.json_field_bside in card:
+        mtg_parse_fields(card[config.json_field_bside])
+
+def mtg_load_cache(cname, key):
+    if not os.path.isfile(cname):
+        return None
+    # the garbage collector keeps rescanning everything while we unpickle
+    # lots of small objects, and there can't be any cycles in here anyway
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(cname, 'rb') as f:
+            if pickle.load(f) == key:
+                return pickle.load(f)
+    # a stale or truncated cache is just a cache miss
+    except (IOError, EOFError, ValueError, AttributeError, ImportError,
+            pickle.UnpicklingError):
+        pass
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return None
+
+def mtg_save_cache(cname, key, allcards):
+    # write to a temporary file first so that nobody ever sees half a cache
+    tmpname = cname + '.' + str(os.getpid())
+    try:
+        with open(tmpname, 'wb') as f:
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(allcards, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, cname)
+    except (IOError, OSError):
+        # not being able to cache shouldn't stop us from doing anything else
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
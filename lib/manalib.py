@@ -5,16 +5,31 @@ import random
 
 import utils
 
-class Manacost:
+# What each symbol says about the colors of a cost, and which symbol it counts as in
+# the symbol table that doesn't include the alternate orderings. Both are hardcoded to
+# be dependent on the symbol structure... ah well
+mana_sym_colors = {sym : re.sub(r'2|P|S|X', '', sym) for sym in utils.mana_symall}
+mana_sym_canonical = {sym : (utils.mana_alt(sym) if sym in utils.mana_symalt else sym)
+                      for sym in utils.mana_symall}
+
+# where each symbol's count lives in Manacost.counts
+mana_sym_index = {sym : i for i, sym in enumerate(utils.mana_symall)}
+
+class Manacost(object):
     '''mana cost representation with data'''
+
+    # There are only a few thousand different costs, shared by a great many cards, so
+    # they're interned (see intern_manacost below) and never changed after parsing.
+    # Symbol counts are kept in a tuple in the same order as utils.mana_symall, and
+    # the old dicts are built from it when somebody asks for them.
+    __slots__ = ['raw', 'json', 'parsed', 'valid', 'none', 'inner', 'cmc', 'colorless',
+                 'sequence', 'counts', 'colors']
     
-    # hardcoded to be dependent on the symbol structure... ah well
     def get_colors(self):
         colors = ''
-        for sym in self.symbols:
-            if self.symbols[sym] > 0:
-                symcolors = re.sub(r'2|P|S|X', '', sym)
-                for symcolor in symcolors:
+        for sym, count in zip(utils.mana_symall, self.counts):
+            if count > 0:
+                for symcolor in mana_sym_colors[sym]:
                     if symcolor not in colors:
                         colors += symcolor
         # sort so the order is always consistent
@@ -26,6 +41,19 @@ class Manacost:
                 return False
         return True
 
+    # counts for every symbol, including the alternate orderings
+    @property
+    def allsymbols(self):
+        return dict(zip(utils.mana_symall, self.counts))
+
+    # counts with the alternate orderings folded into the normal ones
+    @property
+    def symbols(self):
+        symbols = dict.fromkeys(utils.mana_syms, 0)
+        for sym, count in zip(utils.mana_symall, self.counts):
+            symbols[mana_sym_canonical[sym]] += count
+        return symbols
+
     def __init__(self, src, fmt = ''):
         # source fields, exactly one will be set
         self.raw = None
@@ -38,10 +66,8 @@ class Manacost:
         self.inner = None
         self.cmc = 0
         self.colorless = 0
-        self.sequence = []
-        self.symbols = {sym : 0 for sym in utils.mana_syms}
-        self.allsymbols = {sym : 0 for sym in utils.mana_symall}
-        self.colors = ''
+        sequence = []
+        counts = [0] * len(utils.mana_symall)
 
         if fmt == 'json':
             self.json = src
@@ -61,47 +87,37 @@ class Manacost:
         else:
             self.inner = text[1:-1]
 
-            # structure mirrors the decoding in utils, but we pull out different data here
-            idx = 0
-            while idx < len(self.inner):
-                # taking this branch is an infinite loop if unary_marker is empty
-                if (len(utils.mana_unary_marker) > 0 and 
-                    self.inner[idx:idx+len(utils.mana_unary_marker)] == utils.mana_unary_marker):
-                    idx += len(utils.mana_unary_marker)
-                    self.sequence += [utils.mana_unary_marker]
-                elif self.inner[idx:idx+len(utils.mana_unary_counter)] == utils.mana_unary_counter:
-                    idx += len(utils.mana_unary_counter)
-                    self.sequence += [utils.mana_unary_counter]
+            # the same scan that utils.mana_untranslate does, but we pull out different
+            # data here
+            for token in utils.mana_scan(self.inner):
+                if utils.mana_unary_marker and token == utils.mana_unary_marker:
+                    sequence += [token]
+                elif token == utils.mana_unary_counter:
+                    sequence += [token]
                     self.colorless += 1
                     self.cmc += 1
+                elif token in utils.mana_symall_decode:
+                    # leave the sequence encoded for convenience
+                    sequence += [token]
+                    sym = utils.mana_symall_decode[token]
+                    counts[mana_sym_index[sym]] += 1
+                    self.cmc += utils.mana_sym_cmc[sym]
                 else:
-                    old_idx = idx
-                    for symlen in range(utils.mana_symlen_min, utils.mana_symlen_max + 1):
-                        encoded_sym = self.inner[idx:idx+symlen]
-                        if encoded_sym in utils.mana_symall_decode:
-                            idx += symlen
-                            # leave the sequence encoded for convenience
-                            self.sequence += [encoded_sym]
-                            sym = utils.mana_symall_decode[encoded_sym]
-                            self.allsymbols[sym] += 1
-                            if sym in utils.mana_symalt:
-                                self.symbols[utils.mana_alt(sym)] += 1
-                            else:
-                                self.symbols[sym] += 1
-                            if sym == utils.mana_X:
-                                self.cmc += 0
-                            elif utils.mana_2 in sym:
-                                self.cmc += 2
-                            else:
-                                self.cmc += 1
-                            break
-                    # otherwise we'll go into an infinite loop if we see a symbol we don't know
-                    if idx == old_idx:
-                        idx += 1
-                        self.valid = False
+                    # a symbol we don't know
+                    self.valid = False
 
+        self.sequence = tuple(sequence)
+        self.counts = tuple(counts)
         self.colors = self.get_colors()
 
+    # Unpickling goes through intern_manacost as well, so the costs of cached cards
+    # are shared with everything else, and we only have to store the source.
+    def __reduce__(self):
+        if self.json is not None:
+            return (intern_manacost, (self.json, 'json'))
+        else:
+            return (intern_manacost, (self.raw,))
+
     def __str__(self):
         if self.none:
             return '_NOCOST_'
@@ -138,6 +154,23 @@ class Manacost:
         return ' '.join(map(lambda s: ld + s + rd, self.sequence))
         
 
+# Costs that we've already parsed, keyed on the source string and format. Real cards
+# only have a few thousand different costs between them, so this doesn't get big,
+# but just in case, we stop adding to it after a while and hand out private copies.
+manacost_cache = {}
+manacost_cache_max = 10000
+
+# Use this instead of making a Manacost directly, unless you really need your own.
+def intern_manacost(src, fmt = ''):
+    key = (fmt == 'json', src)
+    if key in manacost_cache:
+        return manacost_cache[key]
+    cost = Manacost(src, fmt)
+    if len(manacost_cache) < manacost_cache_max:
+        manacost_cache[key] = cost
+    return cost
+
+
 class Manatext:
     '''text representation with embedded mana costs'''
     
@@ -159,7 +192,7 @@ class Manatext:
             manastrs = re.findall(utils.mana_regex, src)
             
         for manastr in manastrs:
-            cost = Manacost(manastr, fmt)
+            cost = intern_manacost(manastr, fmt)
             if not cost.valid:
                 self.valid = False
             self.costs += [cost]
@@ -1,57 +1,230 @@
 import difflib
+import heapq
 import os
+import json
 import jdecode
 import cardlib
 
 libdir = os.path.dirname(os.path.realpath(__file__))
 datadir = os.path.realpath(os.path.join(libdir, '../data'))
 
+# Bump this if the layout of the name tables changes.
+names_version = 1
+
+# how many of the names sharing the most trigrams with a query get scored exactly
+shortlist_size = 300
+
+# The character trigrams of a name, padded so that the ends of the name count too.
+def trigrams(name):
+    padded = '  ' + name + '  '
+    return set([padded[i:i+3] for i in range(0, len(padded) - 2)])
+
+# SequenceMatcher.ratio() can never be more than quick_ratio(), which only looks at
+# how many characters two names have in common, in any order. That's cheap enough to
+# work out for every name at once, and it tells us which names we can safely skip.
+try:
+    import numpy
+
+    class CharCounts:
+        def __init__(self, names):
+            self.lengths = numpy.array([len(name) for name in names])
+            chars = numpy.fromstring(u''.join(names).encode('utf-32-le'), dtype = numpy.uint32)
+            codes, columns = numpy.unique(chars, return_inverse = True)
+            self.alphabet = dict([(unichr(code), i) for i, code in enumerate(codes)])
+            rows = numpy.repeat(numpy.arange(len(names)), self.lengths)
+            self.counts = numpy.zeros((len(names), len(codes)), dtype = numpy.int16)
+            numpy.add.at(self.counts, (rows, columns), 1)
+
+        def bounds(self, name):
+            query = numpy.zeros(len(self.alphabet), dtype = numpy.int16)
+            for c in name:
+                if c in self.alphabet:
+                    query[self.alphabet[c]] += 1
+            matches = numpy.minimum(self.counts, query).sum(axis = 1)
+            return 2.0 * matches / (self.lengths + len(name))
+
+        # indices of the names whose bound is at least threshold
+        def above(self, bounds, threshold):
+            return list(numpy.flatnonzero(bounds >= threshold))
+
+except ImportError:
+    class CharCounts:
+        def __init__(self, names):
+            self.counts = []
+            for name in names:
+                counts = {}
+                for c in name:
+                    counts[c] = counts.get(c, 0) + 1
+                self.counts += [counts]
+            self.lengths = [len(name) for name in names]
+
+        def bounds(self, name):
+            query = {}
+            for c in name:
+                query[c] = query.get(c, 0) + 1
+            return [2.0 * sum([min(k, counts.get(c, 0)) for c, k in query.iteritems()])
+                    / (length + len(name))
+                    for counts, length in zip(self.counts, self.lengths)]
+
+        def above(self, bounds, threshold):
+            return [i for i, bound in enumerate(bounds) if bound >= threshold]
+
+# The name tables map the names of cards, as the Card class sanitizes them, back to
+# their original names in the json. Working that out means parsing every card, so
+# it's saved next to the json the first time and loaded directly after that.
+def names_key(json_fname):
+    st = os.stat(json_fname)
+    return [names_version, st.st_size, int(st.st_mtime), jdecode.cache_stamp()]
+
+def read_names(json_fname, verbose = False):
+    names = {}
+    json_srcs = jdecode.mtg_reduce_json(json_fname, verbose = verbose, cache = True)
+    for json_cardname in sorted(json_srcs):
+        if len(json_srcs[json_cardname]) > 0:
+            jcards = json_srcs[json_cardname]
+
+            # just use the first one
+            idx = 0
+            card = cardlib.Card(jcards[idx])
+            name = card.name
+            jname = jcards[idx]['name']
+                
+            if name in names:
+                print '  Duplicate name ' + name + ', ignoring.'
+            else:
+                names[name] = jname
+    return names
+
+# With key = None, the table is used no matter where it came from, which lets it
+# stand in for a json file that isn't there at all.
+def load_names(names_fname, key = None):
+    try:
+        with open(names_fname, 'rt') as f:
+            table = json.load(f)
+        if key is None or table['key'] == key:
+            return dict(table['names'])
+    # a stale or broken table just gets rebuilt
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_names(names_fname, key, names):
+    tmpname = names_fname + '.' + str(os.getpid())
+    try:
+        with open(tmpname, 'wt') as f:
+            json.dump({'key' : key, 'names' : sorted(names.items())}, f)
+        os.rename(tmpname, names_fname)
+    except (IOError, OSError):
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
 class Namediff:
     def __init__(self, verbose = True,
-                 json_fname = os.path.join(datadir, 'AllSets.json')):
+                 json_fname = os.path.join(datadir, 'AllSets.json'),
+                 names_fname = None):
         self.verbose = verbose
         self.names = {}
+        if names_fname is None:
+            names_fname = json_fname + '.names'
 
         if self.verbose:
             print 'Setting up namediff...'
 
-        if self.verbose:
-            print '  Reading names from: ' + json_fname
-        json_srcs = jdecode.mtg_open_json(json_fname, verbose)
-        namecount = 0
-        for json_cardname in sorted(json_srcs):
-            if len(json_srcs[json_cardname]) > 0:
-                jcards = json_srcs[json_cardname]
-
-                # just use the first one
-                idx = 0
-                card = cardlib.Card(jcards[idx])
-                name = card.name
-                jname = jcards[idx]['name']
-                    
-                if name in self.names:
-                    print '  Duplicate name ' + name + ', ignoring.'
-                else:
-                    self.names[name] = jname
-                    namecount += 1
+        key = None
+        if os.path.isfile(json_fname):
+            key = names_key(json_fname)
+        names = load_names(names_fname, key)
+        if names is None:
+            if self.verbose:
+                print '  Reading names from: ' + json_fname
+            names = read_names(json_fname, verbose = verbose)
+            save_names(names_fname, key, names)
+            if self.verbose:
+                print '  Saved name table to: ' + names_fname
+        elif self.verbose:
+            print '  Loaded name table from: ' + names_fname
+        self.names = names
 
-        print '  Read ' + str(namecount) + ' unique cardnames'
-        print '  Building SequenceMatcher objects.'
+        print '  Read ' + str(len(self.names)) + ' unique cardnames'
         
-        self.matchers = [difflib.SequenceMatcher(b=n, autojunk=False) for n in self.names]
+        # SequenceMatcher objects are only built for the names we actually compare
+        # against, as we need them
+        self.namelist = sorted(self.names)
+        self.matchers = [None] * len(self.namelist)
+
+        print '  Building trigram index.'
+        self.charcounts = CharCounts(self.namelist)
+        # trigram -> indices of the names that contain it
+        self.index = {}
+        self.gramcounts = []
+        for i, name in enumerate(self.namelist):
+            grams = trigrams(name)
+            self.gramcounts += [len(grams)]
+            for gram in grams:
+                if gram in self.index:
+                    self.index[gram] += [i]
+                else:
+                    self.index[gram] = [i]
 
         print '... Done.'
+
+    # The indices of the names most likely to score well against a name: the ones
+    # with the highest dice coefficient over trigrams, best first.
+    def candidates(self, name, shortlist = shortlist_size):
+        grams = trigrams(name)
+        shared = {}
+        for gram in grams:
+            for i in self.index.get(gram, []):
+                shared[i] = shared.get(i, 0) + 1
+        scored = [(2.0 * count / (len(grams) + self.gramcounts[i]), i)
+                  for i, count in shared.iteritems()]
+        scored.sort(reverse = True)
+        return [i for score, i in scored[:shortlist]]
+
+    def ratio(self, name, i):
+        m = self.matchers[i]
+        if m is None:
+            m = difflib.SequenceMatcher(b=self.namelist[i], autojunk=False)
+            self.matchers[i] = m
+        m.set_seq1(name)
+        return (m.ratio(), m.b)
     
-    def nearest(self, name, n=3):
-        for m in self.matchers:
-            m.set_seq1(name)
-        ratios = [(m.ratio(), m.b) for m in self.matchers]
+    # Scoring every name with SequenceMatcher is where all the time goes, so we start
+    # with the shortlist of names that share the most trigrams with the query, and
+    # then only score the other names whose upper bound says they could still make
+    # it into the top n. The results are exactly the same as scoring everything,
+    # which is what shortlist = None does.
+    def nearest(self, name, n=3, shortlist = shortlist_size):
+        if name in self.names:
+            return [(1.0, name)]
+
+        if shortlist is None:
+            ratios = [self.ratio(name, i) for i in range(0, len(self.matchers))]
+        else:
+            shortlisted = self.candidates(name, shortlist)
+            ratios = [self.ratio(name, i) for i in shortlisted]
+            # the n best scores so far, worst first
+            best = heapq.nlargest(n, [r for r, b in ratios])[::-1]
+            threshold = best[0] if len(best) >= n else 0.0
+
+            bounds = self.charcounts.bounds(name)
+            seen = set(shortlisted)
+            rest = [i for i in self.charcounts.above(bounds, threshold) if not i in seen]
+            rest.sort(key = lambda i: bounds[i], reverse = True)
+            for i in rest:
+                if bounds[i] < threshold:
+                    break
+                ratios += [self.ratio(name, i)]
+                if len(best) < n:
+                    heapq.heappush(best, ratios[-1][0])
+                else:
+                    heapq.heappushpop(best, ratios[-1][0])
+                if len(best) >= n:
+                    threshold = best[0]
+
         ratios.sort(reverse = True)
 
         if ratios[0][0] >= 1:
             return ratios[:1]
         else:
             return ratios[:n]
-        
-            
-
@@ -41,9 +41,27 @@ def name_pass_1_sanitize(s):
 # Text Passes.
 
 
+reminder_text_regex = re.compile(r'\(.*\)')
 def text_pass_1_strip_rt(s):
-    return re.sub(r'\(.*\)', '', s)
-
+    return reminder_text_regex.sub('', s)
+
+
+# A few others don't have a convenient comma to detect their nicknames,
+# so we override them here.
+cardname_overrides = [
+    # detectable by splitting on 'the', though that might cause other issues
+    'crovax',
+    'rashka',
+    'phage',
+    'shimatsu',
+    # random and arbitrary: they have a last name, 1996 world champion, etc.
+    'world champion',
+    'axelrod',
+    'hazezon',
+    'rubinia',
+    'rasputin',
+    'hivis',
+]
 
 def text_pass_2_cardname(s, name):
     # Here are some fun edge cases, thanks to jml34 on the forum for 
@@ -65,24 +83,7 @@ def text_pass_2_cardname(s, name):
         if not new_s == s:
             s = new_s
         
-    # A few others don't have a convenient comma to detect their nicknames,
-    # so we override them here.
-    overrides = [
-        # detectable by splitting on 'the', though that might cause other issues
-        'crovax',
-        'rashka',
-        'phage',
-        'shimatsu',
-        # random and arbitrary: they have a last name, 1996 world champion, etc.
-        'world champion',
-        'axelrod',
-        'hazezon',
-        'rubinia',
-        'rasputin',
-        'hivis',
-    ]
-    
-    for override in overrides:
+    for override in cardname_overrides:
         s = s.replace(override, this_marker)
 
     return s
@@ -115,149 +116,188 @@ def text_pass_4a_dashes(s):
 
 # Run this after fixing dashes, because this unbreaks the ~x issue.
 # Also probably don't run this on names, there are a few names with x~ in them.
+x_replacements = [
+    (dash_marker + 'x', '-' + x_marker),
+    ('+x', '+' + x_marker),
+    (' x ', ' ' + x_marker + ' '),
+    ('x:', x_marker + ':'),
+    ('x~', x_marker + '~'),
+    (u'x\u2014', x_marker + u'\u2014'),
+    ('x.', x_marker + '.'),
+    ('x,', x_marker + ','),
+    ('x/x', x_marker + '/' + x_marker),
+]
+
 def text_pass_4b_x(s):
-    s = s.replace(dash_marker + 'x', '-' + x_marker)
-    s = s.replace('+x', '+' + x_marker)
-    s = s.replace(' x ', ' ' + x_marker + ' ')
-    s = s.replace('x:', x_marker + ':')
-    s = s.replace('x~', x_marker + '~')
-    s = s.replace(u'x\u2014', x_marker + u'\u2014')
-    s = s.replace('x.', x_marker + '.')
-    s = s.replace('x,', x_marker + ',')
-    s = s.replace('x/x', x_marker + '/' + x_marker)
+    for old, new in x_replacements:
+        s = s.replace(old, new)
     return s
 
 
+# so, big fat old dictionary time!!!!!!!!!
+allcounters = [
+    'time counter',
+    'devotion counter',
+    'charge counter',
+    'ki counter',
+    'matrix counter',
+    'spore counter',
+    'poison counter',
+    'quest counter',
+    'hatchling counter',
+    'storage counter',
+    'growth counter',
+    'paralyzation counter',
+    'energy counter',
+    'study counter',
+    'glyph counter',
+    'depletion counter',
+    'sleight counter',
+    'loyalty counter',
+    'hoofprint counter',
+    'wage counter',
+    'echo counter',
+    'lore counter',
+    'page counter',
+    'divinity counter',
+    'mannequin counter',
+    'ice counter',
+    'fade counter',
+    'pain counter',
+    #'age counter',
+    'gold counter',
+    'muster counter',
+    'infection counter',
+    'plague counter',
+    'fate counter',
+    'slime counter',
+    'shell counter',
+    'credit counter',
+    'despair counter',
+    'globe counter',
+    'currency counter',
+    'blood counter',
+    'soot counter',
+    'carrion counter',
+    'fuse counter',
+    'filibuster counter',
+    'wind counter',
+    'hourglass counter',
+    'trap counter',
+    'corpse counter',
+    'awakening counter',
+    'verse counter',
+    'scream counter',
+    'doom counter',
+    'luck counter',
+    'intervention counter',
+    'eyeball counter',
+    'flood counter',
+    'eon counter',
+    'death counter',
+    'delay counter',
+    'blaze counter',
+    'magnet counter',
+    'feather counter',
+    'shield counter',
+    'wish counter',
+    'petal counter',
+    'music counter',
+    'pressure counter',
+    'manifestation counter',
+    #'net counter',
+    'velocity counter',
+    'vitality counter',
+    'treasure counter',
+    'pin counter',
+    'bounty counter',
+    'rust counter',
+    'mire counter',
+    'tower counter',
+    #'ore counter',
+    'cube counter',
+    'strife counter',
+    'elixir counter',
+    'hunger counter',
+    'level counter',
+    'winch counter',
+    'fungus counter',
+    'training counter',
+    'theft counter',
+    'arrowhead counter',
+    'sleep counter',
+    'healing counter',
+    'mining counter',
+    'dream counter',
+    'aim counter',
+    'arrow counter',
+    'javelin counter',
+    'gem counter',
+    'bribery counter',
+    'mine counter',
+    'omen counter',
+    'phylactery counter',
+    'tide counter',
+    'polyp counter',
+    'petrification counter',
+    'shred counter',
+    'pupa counter',
+]
+
+# oh god some of the counter names are suffixes of others...
+shortcounters = [
+    'age counter',
+    'net counter',
+    'ore counter',
+]
+
+# All of the counter names in one regex, so we can find them in a single scan. A plain
+# alternation of a hundred names is actually slower than checking for them one at a
+# time, since the regex engine would try every name at every position, so the names
+# are merged into a trie first. Longer names are always tried before shorter ones,
+# and the leftmost match wins, so 'storage counter' is never seen as 'age counter'.
+def trie_regex(strs):
+    trie = {}
+    for string in strs:
+        node = trie
+        for c in string:
+            node = node.setdefault(c, {})
+        node[''] = {}
+
+    def pattern(node):
+        branches = [re.escape(c) + pattern(node[c]) for c in sorted(node) if c]
+        if not branches:
+            return ''
+        elif len(branches) == 1:
+            p = branches[0]
+        else:
+            p = '(?:' + '|'.join(branches) + ')'
+        # a string ends here, but only match it if nothing longer does
+        if '' in node:
+            p = '(?:' + p + ')?'
+        return p
+
+    return re.compile(pattern(trie))
+
+counter_regex_all = trie_regex(allcounters + shortcounters)
+counter_regex_long = trie_regex(allcounters)
+
 # Call this before replacing newlines.
 # This one ends up being really bad because of the confusion
 # with 'counter target spell or ability'.
 def text_pass_5_counters(s):
-    # so, big fat old dictionary time!!!!!!!!!
-    allcounters = [
-        'time counter',
-        'devotion counter',
-        'charge counter',
-        'ki counter',
-        'matrix counter',
-        'spore counter',
-        'poison counter',
-        'quest counter',
-        'hatchling counter',
-        'storage counter',
-        'growth counter',
-        'paralyzation counter',
-        'energy counter',
-        'study counter',
-        'glyph counter',
-        'depletion counter',
-        'sleight counter',
-        'loyalty counter',
-        'hoofprint counter',
-        'wage counter',
-        'echo counter',
-        'lore counter',
-        'page counter',
-        'divinity counter',
-        'mannequin counter',
-        'ice counter',
-        'fade counter',
-        'pain counter',
-        #'age counter',
-        'gold counter',
-        'muster counter',
-        'infection counter',
-        'plague counter',
-        'fate counter',
-        'slime counter',
-        'shell counter',
-        'credit counter',
-        'despair counter',
-        'globe counter',
-        'currency counter',
-        'blood counter',
-        'soot counter',
-        'carrion counter',
-        'fuse counter',
-        'filibuster counter',
-        'wind counter',
-        'hourglass counter',
-        'trap counter',
-        'corpse counter',
-        'awakening counter',
-        'verse counter',
-        'scream counter',
-        'doom counter',
-        'luck counter',
-        'intervention counter',
-        'eyeball counter',
-        'flood counter',
-        'eon counter',
-        'death counter',
-        'delay counter',
-        'blaze counter',
-        'magnet counter',
-        'feather counter',
-        'shield counter',
-        'wish counter',
-        'petal counter',
-        'music counter',
-        'pressure counter',
-        'manifestation counter',
-        #'net counter',
-        'velocity counter',
-        'vitality counter',
-        'treasure counter',
-        'pin counter',
-        'bounty counter',
-        'rust counter',
-        'mire counter',
-        'tower counter',
-        #'ore counter',
-        'cube counter',
-        'strife counter',
-        'elixir counter',
-        'hunger counter',
-        'level counter',
-        'winch counter',
-        'fungus counter',
-        'training counter',
-        'theft counter',
-        'arrowhead counter',
-        'sleep counter',
-        'healing counter',
-        'mining counter',
-        'dream counter',
-        'aim counter',
-        'arrow counter',
-        'javelin counter',
-        'gem counter',
-        'bribery counter',
-        'mine counter',
-        'omen counter',
-        'phylactery counter',
-        'tide counter',
-        'polyp counter',
-        'petrification counter',
-        'shred counter',
-        'pupa counter',
-    ]
+    # SUPER HACKY fix for doubling season
+    if 'more counter' in s:
+        regex = counter_regex_long
+    else:
+        regex = counter_regex_all
+
     usedcounters = []
-    for countername in allcounters:
-        if countername in s:
-            usedcounters += [countername]
-            s = s.replace(countername, counter_marker + ' counter')
-    
-    # oh god some of the counter names are suffixes of others...
-    shortcounters = [
-        'age counter',
-        'net counter',
-        'ore counter',
-    ]
-    for countername in shortcounters:
-        # SUPER HACKY fix for doubling season
-        if countername in s and 'more counter' not in s:
-            usedcounters += [countername]
-            s = s.replace(countername, counter_marker + ' counter')
+    def replace_counter(match):
+        if not match.group() in usedcounters:
+            usedcounters.append(match.group())
+        return counter_marker + ' counter'
+    s = regex.sub(replace_counter, s)
     
     # miraculously this doesn't seem to happen
     # if len(usedcounters) > 1:
@@ -397,6 +437,49 @@ def text_pass_10_symbols(s):
     return utils.to_symbols(s)
 
 
+# A compiled version of the whole chain of text passes, from stripping reminder text
+# to converting to ascii. Most of the passes only ever change a few cards, but each
+# of them still rescans and often copies the whole text, sometimes dozens of times
+# over. So each pass here comes with a guard, compiled from the rules it applies,
+# which has to match somewhere in the text for the pass to change anything at all.
+# Usually one scan for the guard is all we do; when it matches, the pass runs
+# exactly as usual, so the output is always the same as running the chain by hand.
+
+def literal_guard(strs):
+    return re.compile(u'|'.join([re.escape(s) for s in strs]))
+
+cardname_override_guard = literal_guard(cardname_overrides)
+
+def cardname_guard(s, name):
+    if name in s or cardname_override_guard.search(s):
+        return True
+    nameparts = name.split(',')
+    return len(nameparts) > 1 and nameparts[0] in s
+
+# (guard, pass) for everything after the cardname pass, in order
+text_pass_table = [
+    (re.compile(r'[0123456789]'), text_pass_3_unary),
+    (re.compile(r'-|level &\^*\+|' + re.escape(reserved_marker)), text_pass_4a_dashes),
+    (literal_guard([old for old, new in x_replacements]), text_pass_4b_x),
+    (literal_guard(['counter']), text_pass_5_counters),
+    (literal_guard(['counter']), text_pass_6_uncast),
+    (literal_guard(['choose']), text_pass_7_choice),
+    (literal_guard(['equip']), text_pass_8_equip),
+    (literal_guard(['\n']), text_pass_9_newlines),
+    (re.compile(utils.json_symbol_regex), text_pass_10_symbols),
+    (utils.nonascii_regex, utils.to_ascii),
+]
+
+def text_pass_compiled(s, name):
+    s = reminder_text_regex.sub('', s)
+    if cardname_guard(s, name):
+        s = text_pass_2_cardname(s, name)
+    for guard, textpass in text_pass_table:
+        if guard.search(s):
+            s = textpass(s)
+    return s
+
+
 # Text unpasses, for decoding. All assume the text inside a Manatext, so don't do anything
 # weird with the mana cost symbol.
 
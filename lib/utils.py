@@ -61,6 +61,25 @@ field_label_text = config.field_label_text
 # additional fields we add to the json cards
 json_field_bside = config.json_field_bside
 json_field_set_name = config.json_field_set_name
+json_field_fields = config.json_field_fields
+
+# Read a file of encoded cards a piece at a time, yielding each card's text as soon as
+# we've seen the whole thing. Gives the same cards as f.read().split(cardsep), minus
+# the empty ones, without ever holding more than a chunk and a card in memory.
+def stream_cards(f, chunk_size = 1 << 20):
+    rest = ''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        # rest never contains a whole separator, so this splits just like the whole file would
+        card_srcs = (rest + chunk).split(cardsep)
+        rest = card_srcs.pop()
+        for card_src in card_srcs:
+            if card_src:
+                yield card_src
+    if rest:
+        yield rest
 
 # unicode / ascii conversion
 unicode_trans = {
@@ -80,11 +99,17 @@ unicode_trans = {
     u'\xed' : 'i', # i with accent
 }
 
+# unicode.translate wants the code points, and can replace them with whole strings
+unicode_trans_table = {ord(uchar) : unicode(unicode_trans[uchar]) for uchar in unicode_trans}
+nonascii_regex = re.compile(ur'[^\x00-\x7f]')
+
 # this one is one-way only
 def to_ascii(s):
-    for uchar in unicode_trans:
-        s = s.replace(uchar, unicode_trans[uchar])
-    return s
+    # translate() is slow in python 2, and most strings are ascii already anyway;
+    # either way we hand back unicode, same as all those replace() calls used to
+    if nonascii_regex.search(s):
+        return unicode(s).translate(unicode_trans_table)
+    return unicode(s)
 
 # unary numbers
 unary_marker = config.unary_marker
@@ -92,7 +117,8 @@ unary_counter = config.unary_counter
 unary_max = config.unary_max
 unary_exceptions = config.unary_exceptions
 
-def to_unary(s, warn = False):
+# The slow way to convert numbers to unary, one number at a time.
+def to_unary_sequential(s, warn = False):
     numbers = re.findall(r'[0123456789]+', s)
     # replace largest first to avoid accidentally replacing shared substrings
     for n in sorted(numbers, cmp = lambda x,y: cmp(int(x), int(y)), reverse = True):
@@ -108,13 +134,49 @@ def to_unary(s, warn = False):
             s = s.replace(n, unary_marker + unary_counter * i)
     return s
 
+# What each number turns into, looked up by its digits, with the exceptions and
+# clamping already worked out. Anything bigger than this is clamped, unless it's
+# one of the exceptions.
+unary_memo_max = 999
+unary_clamped = unary_marker + unary_counter * unary_max
+unary_memo = {}
+for i in range(0, unary_memo_max + 1):
+    if i in unary_exceptions:
+        unary_memo[str(i)] = unary_exceptions[i]
+    else:
+        unary_memo[str(i)] = unary_marker + unary_counter * min(i, unary_max)
+
+def unary_digits(digits):
+    if digits in unary_memo:
+        return unary_memo[digits]
+    i = int(digits)
+    if i in unary_exceptions:
+        return unary_exceptions[i]
+    return unary_clamped
+
+decimal_regex = re.compile(r'[0123456789]+')
+leading_zero_regex = re.compile(r'(?<![0123456789])0[0123456789]')
+
+# The fast way, replacing every number in a single pass. That gives exactly the same
+# results as doing them one at a time, unless some number has leading zeros: then
+# 05 and 5 are the same number, and which one went first matters, so we leave those
+# to to_unary_sequential, along with anything we're supposed to warn about.
+def to_unary(s, warn = False):
+    # most calls are for a power or toughness that's just a number; the empty slice
+    # keeps the result unicode if that's what we were given, like replace() would
+    if s in unary_memo:
+        return s[:0] + unary_memo[s]
+    elif warn or leading_zero_regex.search(s):
+        return to_unary_sequential(s, warn)
+    return decimal_regex.sub(lambda match: unary_digits(match.group()), s)
+
+unary_regex = re.compile(re.escape(unary_marker + unary_counter) + '*')
+
+# Every unary number is a whole run of counters, so there's no need to worry about
+# replacing substrings here, and we can do it in one pass.
 def from_unary(s):
-    numbers = re.findall(re.escape(unary_marker + unary_counter) + '*', s)
-    # again, largest first so we don't replace substrings and break everything
-    for n in sorted(numbers, cmp = lambda x,y: cmp(len(x), len(y)), reverse = True):
-        i = (len(n) - len(unary_marker)) / len(unary_counter)
-        s = s.replace(n, str(i))
-    return s
+    return unary_regex.sub(
+        lambda match: str((len(match.group()) - len(unary_marker)) / len(unary_counter)), s)
 
 # mana syntax
 mana_open_delimiter = '{'
@@ -353,53 +415,66 @@ mana_decimal_regex = (re.escape(mana_json_open_delimiter) + number_decimal_regex
 mana_unary_regex = (re.escape(mana_json_open_delimiter) + number_unary_regex
                     + re.escape(mana_json_close_delimiter))
 
+# Everything that can show up in a json mana string, in one regex: unary and decimal
+# numbers, and all of the symbols, longest first. None of these can overlap, since
+# they're all delimited, so one pass does the same as replacing each kind in turn.
+mana_json_symbols_longest = sorted(mana_symall_jdecode, key = len, reverse = True)
+mana_json_token_regex = re.compile('|'.join(['(' + mana_unary_regex + ')',
+                                             '(' + mana_decimal_regex + ')']
+                                            + [re.escape(jsym) for jsym in
+                                               mana_json_symbols_longest]))
+
+def mana_translate_token(match):
+    unary, decimal = match.groups()
+    if unary:
+        ns = re.findall(number_unary_regex, unary)
+        i = (len(ns[0]) - len(unary_marker)) / len(unary_counter)
+    elif decimal:
+        i = int(decimal[len(mana_json_open_delimiter):-len(mana_json_close_delimiter)])
+    else:
+        return mana_encode_direct(match.group())
+    return mana_unary_marker + mana_unary_counter * i
+
 # convert a json mana string to the proper encoding
 def mana_translate(jmanastr):
-    manastr = jmanastr
-    for n in sorted(re.findall(mana_unary_regex, manastr),
-                    lambda x,y: cmp(len(x), len(y)), reverse = True):
-        ns = re.findall(number_unary_regex, n)
-        i = (len(ns[0]) - len(unary_marker)) / len(unary_counter)
-        manastr = manastr.replace(n, mana_unary_marker + mana_unary_counter * i)
-    for n in sorted(re.findall(mana_decimal_regex, manastr),
-                        lambda x,y: cmp(len(x), len(y)), reverse = True):
-        ns = re.findall(number_decimal_regex, n)
-        i = int(ns[0])
-        manastr = manastr.replace(n, mana_unary_marker + mana_unary_counter * i)
-    for jsym in sorted(mana_symall_jdecode, lambda x,y: cmp(len(x), len(y)), reverse = True):
-        if jsym in manastr:
-            manastr = manastr.replace(jsym, mana_encode_direct(jsym))
-    return mana_open_delimiter + manastr + mana_close_delimiter
+    return (mana_open_delimiter + mana_json_token_regex.sub(mana_translate_token, jmanastr)
+            + mana_close_delimiter)
+
+# Everything that can show up inside an encoded mana string, tried in the same order
+# that we always have: unary markers, then counters, then the symbols, shortest
+# first. Since all of the encoded symbols are the same length, that's also the same as
+# going longest first. Anything else is a single character we don't understand. This
+# is shared by mana_untranslate and manalib.Manacost, so both read costs the same way.
+mana_tokens = ([mana_unary_marker] if mana_unary_marker else []) + [mana_unary_counter]
+mana_tokens += sorted(mana_symall_decode, key = len)
+mana_token_regex = re.compile('|'.join([re.escape(token) for token in mana_tokens]) + '|.',
+                              re.DOTALL)
+
+def mana_scan(inner):
+    return mana_token_regex.findall(inner)
+
+# what each symbol adds to the converted mana cost
+mana_sym_cmc = {sym : (0 if sym == mana_X else 2 if mana_2 in sym else 1)
+                for sym in mana_symall}
+
+# straight from encoded symbols to json or forum formatting
+mana_symall_decode_direct = {sym : mana_decode_direct(sym) for sym in mana_symall_decode}
+mana_symall_decode_forum = {sym : mana_decode_direct_forum(sym) for sym in mana_symall_decode}
 
 # convert an encoded mana string back to json
-mana_symlen_min = min([len(sym) for sym in mana_symall_decode])
-mana_symlen_max = max([len(sym) for sym in mana_symall_decode])
 def mana_untranslate(manastr, for_forum = False):
-    inner = manastr[1:-1]
-    jmanastr = ''
+    if for_forum:
+        decode_table = mana_symall_decode_forum
+    else:
+        decode_table = mana_symall_decode_direct
+    jsyms = []
     colorless_total = 0
-    idx = 0
-    while idx < len(inner):
-        # taking this branch is an infinite loop if unary_marker is empty
-        if len(mana_unary_marker) > 0 and inner[idx:idx+len(mana_unary_marker)] == mana_unary_marker:
-            idx += len(mana_unary_marker)
-        elif inner[idx:idx+len(mana_unary_counter)] == mana_unary_counter:
-            idx += len(mana_unary_counter)
+    for token in mana_scan(manastr[1:-1]):
+        if token == mana_unary_counter:
             colorless_total += 1
-        else:
-            old_idx = idx
-            for symlen in range(mana_symlen_min, mana_symlen_max + 1):
-                sym = inner[idx:idx+symlen]
-                if sym in mana_symall_decode:
-                    idx += symlen
-                    if for_forum:
-                        jmanastr = jmanastr + mana_decode_direct_forum(sym)
-                    else:
-                        jmanastr = jmanastr + mana_decode_direct(sym)
-                    break
-            # otherwise we'll go into an infinite loop if we see a symbol we don't know
-            if idx == old_idx:
-                idx += 1
+        elif token in decode_table:
+            jsyms += [decode_table[token]]
+    jmanastr = ''.join(jsyms)
     if for_forum:
         if jmanastr == '':
             return mana_forum_open_delimiter + str(colorless_total) + mana_forum_close_delimiter
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+
+libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../lib')
+sys.path.append(libdir)
+import utils
+import jdecode
+
+# The way to_ascii used to work, one replace() for each character we know about.
+def to_ascii_replace(s):
+    for uchar in utils.unicode_trans:
+        s = s.replace(uchar, utils.unicode_trans[uchar])
+    return s
+
+# every string in a decoded json value, keys included
+def json_strings(obj, strs):
+    if isinstance(obj, basestring):
+        strs += [obj]
+    elif isinstance(obj, dict):
+        for k in obj:
+            json_strings(k, strs)
+            json_strings(obj[k], strs)
+    elif isinstance(obj, list):
+        for v in obj:
+            json_strings(v, strs)
+    return strs
+
+def timeit(f, strs, repeat):
+    best = None
+    for r in range(0, repeat):
+        start = time.time()
+        results = [f(s) for s in strs]
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, results
+
+# Run every string in a json corpus, plus some made of the characters to_ascii
+# knows about, through the old replace() loop and the current to_ascii, and check
+# that they give the same strings, of the same type.
+def main(fname, repeat = 3, verbose = False):
+    strs = []
+    with open(fname, 'rb') as f:
+        for k_set, setdata in jdecode.json_stream_pairs(f):
+            json_strings(k_set, strs)
+            json_strings(setdata, strs)
+    uchars = u''.join(sorted(utils.unicode_trans))
+    strs += [uchars, u'x' + u' '.join(uchars) + u'x', 'plain str']
+
+    old_time, old_results = timeit(to_ascii_replace, strs, repeat)
+    new_time, new_results = timeit(utils.to_ascii, strs, repeat)
+    mismatches = 0
+    for s, old, new in zip(strs, old_results, new_results):
+        if old != new or type(old) != type(new):
+            mismatches += 1
+            if verbose:
+                print 'mismatch for ' + repr(s) + ': ' + repr(old) + ' vs ' + repr(new)
+
+    print str(len(strs)) + ' strings, best of ' + str(repeat) + ' runs'
+    print '  replace() loop: ' + str(old_time) + 's'
+    print '  to_ascii: ' + str(new_time) + 's'
+    print '  ' + str(mismatches) + ' different results'
+    return mismatches == 0
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('infile', #nargs='?'. default=None,
+                        help='json corpus to take strings from')
+    parser.add_argument('-r', '--repeat', action='store', type=int, default=3,
+                        help='number of times to run each conversion')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='verbose output, including any mismatches')
+
+    args = parser.parse_args()
+    if not main(args.infile, repeat = args.repeat, verbose = args.verbose):
+        exit(1)
+    exit(0)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+import sys
+import os
+import gc
+import time
+import subprocess
+
+libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../lib')
+
+# Add up the size of everything reachable from objs, counting shared objects (like
+# interned strings and mana costs) only once. Classes and modules aren't part of
+# any one card, so we don't follow them.
+def footprint(objs):
+    seen = set()
+    total = 0
+    todo = list(objs)
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, (type, type(sys))):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        todo += gc.get_referents(obj)
+    return total
+
+def rss_kb():
+    with open('/proc/self/status', 'rt') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+# Load the cards with whatever cardlib is in card_libdir and print one line of
+# numbers. This runs in its own process, so different versions of the library can't
+# get mixed up with each other and the rss figure means something.
+def measure(fname, card_libdir, limit = 0):
+    sys.path.insert(0, card_libdir)
+    import utils
+    import cardlib
+
+    gc.disable()
+    with open(fname, 'rt') as f:
+        srcs = [card_src for card_src in utils.stream_cards(f)]
+    if limit > 0:
+        srcs = srcs[:limit]
+
+    rss_before = rss_kb()
+    start = time.time()
+    cards = [cardlib.Card(card_src) for card_src in srcs]
+    elapsed = time.time() - start
+    rss_after = rss_kb()
+
+    print len(cards), footprint(cards), (rss_after - rss_before) * 1024, elapsed
+
+# Compare the memory used per card by the Card class in each of the given library
+# directories. To compare against an older version, check it out somewhere else
+# (git worktree add /tmp/old <commit>) and pass --lib /tmp/old/lib as well.
+def main(fname, libs = [], limit = 0):
+    libs = [os.path.realpath(libdir)] + [os.path.realpath(lib) for lib in libs]
+    for lib in libs:
+        output = subprocess.check_output([sys.executable, os.path.realpath(__file__),
+                                          fname, '--measure', lib,
+                                          '--limit', str(limit)])
+        ncards, size, rss, elapsed = output.split()
+        ncards = max(int(ncards), 1)
+        print lib + ':'
+        print ('  ' + str(ncards) + ' cards, '
+               + str(int(size) / ncards) + ' bytes per card reachable, '
+               + str(int(rss) / ncards) + ' bytes per card rss, '
+               + str(float(elapsed)) + 's to construct')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('infile', #nargs='?'. default=None,
+                        help='encoded card file to load')
+    parser.add_argument('--lib', action='append', default=[],
+                        help='another lib directory to compare against, can be repeated')
+    parser.add_argument('-l', '--limit', action='store', type=int, default=0,
+                        help='only load this many cards')
+    parser.add_argument('--measure', action='store', default=None,
+                        help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.measure:
+        measure(args.infile, args.measure, limit = args.limit)
+    else:
+        main(args.infile, libs = args.lib, limit = args.limit)
+    exit(0)
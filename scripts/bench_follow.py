@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import random
+import StringIO
+
+libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../lib')
+sys.path.append(libdir)
+import utils
+import datalib
+
+# Everything summarize.py -x would print about a mine. Not -a: the unparsed cards it
+# dumps have object addresses in them.
+def report(mine):
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        mine.summarize()
+        mine.outliers()
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+# Write the cards of an encoded file out again with up to extra more newlines after
+# each card separator, the way summarize.py -f would see it if something else was
+# writing it: in random pieces, with an update() after each one. Then check that the
+# indices come out the same as reading the finished file all at once.
+def main(fname, extra = 1, chunk = 65536, seed = 0):
+    with open(fname, 'rb') as f:
+        card_srcs = [card_src for card_src in f.read().split(utils.cardsep) if card_src]
+    random.seed(seed)
+    data = ''.join(card_src + utils.cardsep + '\n' * random.randint(0, extra)
+                   for card_src in card_srcs[:-1])
+    # a finished file ends with a card separator, not the start of another card
+    data += card_srcs[-1] + utils.cardsep
+
+    tmpname = fname + '.follow.' + str(os.getpid())
+    try:
+        with open(tmpname, 'wb') as f:
+            f.write(data)
+        start = time.time()
+        whole = datalib.Datamine(source = tmpname)
+        whole_time = time.time() - start
+
+        updates = 0
+        with open(tmpname, 'wb') as f:
+            pass
+        start = time.time()
+        mine = datalib.Datamine(source = tmpname, end = datalib.complete_end(tmpname))
+        pos = 0
+        while pos < len(data):
+            n = random.randint(1, 2 * chunk)
+            with open(tmpname, 'ab') as f:
+                f.write(data[pos:pos + n])
+            pos += n
+            mine.update()
+            updates += 1
+        follow_time = time.time() - start
+
+        same = report(mine) == report(whole)
+        for name in ['offsets', 'lengths', 'unparsed_offsets', 'unparsed_lengths']:
+            same = same and list(getattr(mine, name)) == list(getattr(whole, name))
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+    print (str(len(card_srcs)) + ' cards, separated by up to ' + str(extra)
+           + ' extra newlines, written in ' + str(updates) + ' pieces')
+    print '  read all at once: ' + str(len(whole.table)) + ' cards, ' + str(whole_time) + 's'
+    print '  followed: ' + str(len(mine.table)) + ' cards, ' + str(follow_time) + 's'
+    if not same:
+        print '  DIFFERENT RESULTS'
+        return False
+    print '  same results'
+    return True
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('infile', #nargs='?'. default=None,
+                        help='encoded card file to take cards from')
+    parser.add_argument('-e', '--extra', action='store', type=int, default=1,
+                        help='most extra newlines to put after each card separator')
+    parser.add_argument('-c', '--chunk', action='store', type=int, default=65536,
+                        help='average number of bytes to write between updates')
+    parser.add_argument('-s', '--seed', action='store', type=int, default=0,
+                        help='random seed for the separators and piece sizes')
+
+    args = parser.parse_args()
+    if not main(args.infile, extra = args.extra, chunk = args.chunk, seed = args.seed):
+        exit(1)
+    exit(0)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+
+libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../lib')
+sys.path.append(libdir)
+import utils
+import cardlib
+import namediff
+
+# Splice the front of each name onto the back of the next one, like the names a
+# network tends to come up with. Real names are found without any scoring at all, so
+# they wouldn't tell us much.
+def mix_names(names, real_names):
+    mixed = []
+    for name, other in zip(names, names[1:] + names[:1]):
+        words = name.split()
+        others = other.split()
+        query = ' '.join(words[:(len(words) + 1) / 2] + others[len(others) / 2:])
+        if not query in real_names:
+            mixed += [query]
+    return mixed
+
+# Time Namediff.nearest on names made up from the names of some encoded cards,
+# scoring every name the old way and then with the trigram shortlist, and check
+# that they agree.
+def main(fname, n = 3, limit = 0, shortlist = None, verbose = False):
+    with open(fname, 'rt') as f:
+        names = []
+        for card_src in utils.stream_cards(f):
+            names += [cardlib.Card(card_src).name]
+            if limit > 0 and len(names) >= limit:
+                break
+
+    nd = namediff.Namediff(verbose = verbose)
+    names = mix_names(names, nd.names)
+    if shortlist is None:
+        shortlist = namediff.shortlist_size
+
+    times = {}
+    results = {}
+    for mode, size in [('full scan', None), ('shortlist', shortlist)]:
+        start = time.time()
+        results[mode] = [nd.nearest(name, n, size) for name in names]
+        times[mode] = time.time() - start
+
+    mismatches = 0
+    for name, full, short in zip(names, results['full scan'], results['shortlist']):
+        if full != short:
+            mismatches += 1
+            if verbose:
+                print 'mismatch for ' + name + ':'
+                print '  full scan: ' + repr(full)
+                print '  shortlist: ' + repr(short)
+
+    print str(len(names)) + ' queries against ' + str(len(nd.names)) + ' names'
+    for mode in ['full scan', 'shortlist']:
+        print ('  ' + mode + ': ' + str(times[mode]) + 's total, '
+               + str(1000.0 * times[mode] / max(len(names), 1)) + 'ms per query')
+    print '  ' + str(mismatches) + ' queries with different results'
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('infile', #nargs='?'. default=None,
+                        help='encoded card file to take query names from')
+    parser.add_argument('-n', action='store', type=int, default=3,
+                        help='number of nearest names to look up')
+    parser.add_argument('-l', '--limit', action='store', type=int, default=0,
+                        help='only use this many query names')
+    parser.add_argument('-s', '--shortlist', action='store', type=int, default=None,
+                        help='number of names to score exactly for each query')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='verbose output, including any mismatches')
+
+    args = parser.parse_args()
+    main(args.infile, n = args.n, limit = args.limit, shortlist = args.shortlist,
+         verbose = args.verbose)
+    exit(0)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+
+libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../lib')
+sys.path.append(libdir)
+import utils
+import datalib
+
+default_queries = [
+    'color:green type:creature cmc<=3 power>=4',
+    'type:instant cmc=1',
+    'color:red color:white type:creature',
+    'supertype:legendary type:creature power>=5',
+    'type:planeswalker loyalty>=4',
+    'subtype:goblin',
+    'textlines>=6',
+    'valid=0',
+]
+
+# What a card has in each index, and its number in each numeric column (None if it
+# doesn't have one), taken straight from the card: this is what a script would have
+# to look at to answer a query without the indices.
+def card_colors(card):
+    return card.cost.colors if card.cost.colors else 'A'
+
+def card_text(card):
+    return card.text.encode()
+
+def card_textlines(card):
+    text = card_text(card)
+    return text.count(utils.newline) + 1 if text else 0
+
+def card_number(s):
+    if not s:
+        return None
+    try:
+        return int(utils.from_unary(s))
+    except ValueError:
+        return None
+
+card_keys = {
+    'by_name' : lambda card: [card.name],
+    'by_type' : lambda card: [' '.join(card.types)],
+    'by_type_inclusive' : lambda card: card.types,
+    'by_supertype' : lambda card: [' '.join(card.supertypes)],
+    'by_supertype_inclusive' : lambda card: card.supertypes,
+    'by_subtype' : lambda card: [' '.join(card.subtypes)],
+    'by_subtype_inclusive' : lambda card: card.subtypes,
+    'by_color' : lambda card: [card_colors(card)],
+    'by_color_inclusive' : lambda card: list(card_colors(card)),
+    'by_color_count' : lambda card: [len(card.cost.colors)],
+    'by_cmc' : lambda card: [card.cost.cmc],
+    'by_cost' : lambda card: [card.cost.encode() or 'none'],
+    'by_power' : lambda card: [card.pt_p],
+    'by_toughness' : lambda card: [card.pt_t],
+    'by_pt' : lambda card: [card.pt],
+    'by_loyalty' : lambda card: [card.loyalty],
+    'by_textlines' : lambda card: [card_textlines(card)],
+    'by_textlen' : lambda card: [len(card_text(card))],
+}
+
+card_values = {
+    'cmc' : lambda card: card.cost.cmc,
+    'colors' : lambda card: sum(datalib.color_bits.get(c, 0) for c in set(card.cost.colors)),
+    'power' : lambda card: card_number(card.pt_p),
+    'toughness' : lambda card: card_number(card.pt_t),
+    'loyalty' : lambda card: card_number(card.loyalty),
+    'textlen' : lambda card: len(card_text(card)),
+    'textlines' : card_textlines,
+    'valid' : lambda card: 1 if card.valid else 0,
+}
+
+# Does card match query? Cards without a number never match a comparison on it.
+def scan_matches(card, query):
+    for term in query.terms:
+        if term[0] == 'has':
+            kind, index_name, key = term
+            if not key in card_keys[index_name](card):
+                return False
+        else:
+            kind, name, op, value = term
+            v = card_values[name](card)
+            if v is None or not datalib.comparisons[op](v, value):
+                return False
+    return True
+
+# Time each query through the indices against a full scan of every parsed card in
+# the file, and check that they find the same cards.
+def main(fname, queries = [], cache = True, verbose = False):
+    mine = datalib.open_mine(fname, verbose = verbose, cache = cache)
+    if not queries:
+        queries = default_queries
+    # neither the first query nor the first scan should pay for setting things up:
+    # grouping the postings lists, or parsing the cards
+    for index in mine.indices.values():
+        index.group()
+    cards = list(mine.allcards)
+
+    print str(len(queries)) + ' queries against ' + str(len(mine.table)) + ' cards'
+    totals = {'query' : 0.0, 'full scan' : 0.0}
+    mismatches = 0
+    for text in queries:
+        query = mine.query(text)
+        start = time.time()
+        found = list(query.ids())
+        query_time = time.time() - start
+
+        start = time.time()
+        scanned = [card_id for card_id, card in enumerate(cards)
+                   if scan_matches(card, query)]
+        scan_time = time.time() - start
+
+        totals['query'] += query_time
+        totals['full scan'] += scan_time
+        if found != scanned:
+            mismatches += 1
+        print '  ' + text + ':'
+        print ('    ' + str(len(found)) + ' cards, query: ' + str(1000.0 * query_time)
+               + 'ms, full scan: ' + str(1000.0 * scan_time) + 'ms'
+               + ('' if found == scanned else ', DIFFERENT RESULTS'))
+        if verbose:
+            sizes = [term.size() for term in query.plan()]
+            print '    terms match ' + ', '.join(map(str, sizes)) + ' cards'
+
+    for mode in ['query', 'full scan']:
+        print ('  ' + mode + ': ' + str(totals[mode]) + 's total, '
+               + str(1000.0 * totals[mode] / len(queries)) + 'ms per query')
+    print '  ' + str(mismatches) + ' queries with different results'
+    return mismatches == 0
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('infile', #nargs='?'. default=None,
+                        help='encoded card file to query')
+    parser.add_argument('-q', '--query', action='append', default=[],
+                        help='query to time instead of the default ones, can be repeated')
+    parser.add_argument('-n', '--no-index', action='store_true',
+                        help="don't load or save an index file next to the card file")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='verbose output, including the size of each query term')
+
+    args = parser.parse_args()
+    if not main(args.infile, queries = args.query, cache = not args.no_index,
+                verbose = args.verbose):
+        exit(1)
+    exit(0)
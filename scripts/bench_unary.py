@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+import sys
+import os
+import re
+import time
+
+libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../lib')
+sys.path.append(libdir)
+import utils
+
+# The way from_unary used to work, replacing one number at a time, largest first.
+def from_unary_sequential(s):
+    numbers = re.findall(re.escape(utils.unary_marker + utils.unary_counter) + '*', s)
+    for n in sorted(numbers, cmp = lambda x,y: cmp(len(x), len(y)), reverse = True):
+        i = (len(n) - len(utils.unary_marker)) / len(utils.unary_counter)
+        s = s.replace(n, str(i))
+    return s
+
+def timeit(f, strs, repeat):
+    best = None
+    for r in range(0, repeat):
+        start = time.time()
+        results = [f(s) for s in strs]
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, results
+
+# Time the unary conversions on the fields of the cards in an encoded file, going
+# from unary with the fields as they are, and back to unary with the numbers converted
+# to decimal. The field labels are left off, since they're digits too.
+def main(fname, repeat = 3):
+    encoded = []
+    with open(fname, 'rt') as f:
+        for card_src in utils.stream_cards(f):
+            encoded += [field[1:] for field in card_src.split(utils.fieldsep) if field]
+    decoded = [from_unary_sequential(s) for s in encoded]
+
+    print str(len(encoded)) + ' fields, best of ' + str(repeat) + ' runs'
+    for name, old, new, strs in [('from_unary', from_unary_sequential, utils.from_unary, encoded),
+                                 ('to_unary', utils.to_unary_sequential, utils.to_unary, decoded)]:
+        old_time, old_results = timeit(old, strs, repeat)
+        new_time, new_results = timeit(new, strs, repeat)
+        mismatches = len([1 for a, b in zip(old_results, new_results) if a != b])
+        print ('  ' + name + ': ' + str(old_time) + 's one at a time, '
+               + str(new_time) + 's in one pass, ' + str(mismatches) + ' different results')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('infile', #nargs='?'. default=None,
+                        help='encoded card file to convert')
+    parser.add_argument('-r', '--repeat', action='store', type=int, default=3,
+                        help='number of times to run each conversion')
+
+    args = parser.parse_args()
+    main(args.infile, repeat = args.repeat)
+    exit(0)
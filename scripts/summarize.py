@@ -1,34 +1,85 @@
 #!/usr/bin/env python
 import sys
 import os
+import time
 
 libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../lib')
 sys.path.append(libdir)
 import utils
 import jdecode
+import datalib
 from datalib import Datamine
 
-def main(fname, verbose = True, outliers = False, dump_all = False):
+# Print the first limit cards that match a query (all of them if limit is 0), and
+# how many there were.
+def run_query(mine, text, query, limit = 10):
+    print '===================='
+    print 'Cards matching: ' + text
+    matched = 0
+    for card_id in query:
+        if limit <= 0 or matched < limit:
+            print '\n' + mine.card(card_id).format(gatherer = True)
+        matched += 1
+    print '--------------------'
+    print str(matched) + ' cards matched.'
+
+def report(mine, outliers = False, dump_all = False, queries = [], limit = 10):
+    if queries:
+        # parse them all first, so that a bad one stops us before we print anything
+        parsed = [mine.query(text) for text in queries]
+        for text, query in zip(queries, parsed):
+            run_query(mine, text, query, limit = limit)
+        return
+    mine.summarize()
+    if outliers or dump_all:
+        mine.outliers(dump_invalid = dump_all)
+
+# Keep watching an encoded card file that something else is still writing to, and
+# print the summary again every interval seconds with whatever cards have been
+# added since. Only the new part of the file is ever read.
+def follow(fname, interval, verbose = True, outliers = False, dump_all = False,
+           jobs = 1, queries = [], limit = 10):
+    if verbose:
+        print 'Following encoded card file: ' + fname
+    mine = datalib.build_mine(fname, jobs, end = datalib.complete_end(fname))
+    report(mine, outliers = outliers, dump_all = dump_all, queries = queries,
+           limit = limit)
+    try:
+        while True:
+            time.sleep(interval)
+            added = mine.update()
+            if verbose:
+                print 'Read ' + str(added) + ' new cards, up to byte ' + str(mine.end)
+            report(mine, outliers = outliers, dump_all = dump_all, queries = queries,
+                   limit = limit)
+    except KeyboardInterrupt:
+        pass
+
+def main(fname, verbose = True, outliers = False, dump_all = False, cache = True,
+         interval = None, jobs = 1, queries = [], limit = 10):
+    if interval is not None:
+        if fname[-5:] == '.json':
+            raise ValueError('can only follow an encoded card file, not ' + fname)
+        follow(fname, interval, verbose = verbose, outliers = outliers,
+               dump_all = dump_all, jobs = jobs, queries = queries, limit = limit)
+        return
+
     if fname[-5:] == '.json':
         if verbose:
             print 'This looks like a json file: ' + fname
-        json_srcs = jdecode.mtg_open_json(fname, verbose)
+        json_srcs = jdecode.mtg_reduce_json(fname, verbose = verbose, cache = cache)
         card_srcs = []
         for json_cardname in sorted(json_srcs):
             if len(json_srcs[json_cardname]) > 0:
                 card_srcs += [json_srcs[json_cardname][0]]
+        mine = Datamine(card_srcs)
     else:
         if verbose:
             print 'Opening encoded card file: ' + fname
-        with open(fname, 'rt') as f:
-            text = f.read()
-        card_srcs = text.split(utils.cardsep)
-
-    mine = Datamine(card_srcs)
-    mine.summarize()
-    if outliers or dump_all:
-        mine.outliers(dump_invalid = dump_all)
+        mine = datalib.open_mine(fname, verbose = verbose, cache = cache, jobs = jobs)
 
+    report(mine, outliers = outliers, dump_all = dump_all, queries = queries,
+           limit = limit)
 
 if __name__ == '__main__':
     import argparse
@@ -40,9 +91,29 @@ if __name__ == '__main__':
                         help='show additional diagnostics and edge cases')
     parser.add_argument('-a', '--all', action='store_true',
                         help='show all information and dump invalid cards')
+    parser.add_argument('-n', '--no-index', action='store_true',
+                        help="don't load or save a cache or index file next to the input file")
+    parser.add_argument('-f', '--follow', action='store', type=float, default=None,
+                        metavar='SECONDS',
+                        help='keep reading cards as they are added to an encoded card file, '
+                        + 'and print the summary again every SECONDS seconds')
+    parser.add_argument('-q', '--query', action='append', default=[],
+                        help='instead of a summary, show the cards matching a query like '
+                        + '"color:green type:creature cmc<=3 power>=4"; can be repeated')
+    parser.add_argument('-l', '--limit', metavar='N', type=int, default=10,
+                        help='show at most N cards for each query, or all of them for 0 '
+                        + '(default 10)')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='number of processes to use for reading an encoded card file')
     parser.add_argument('-v', '--verbose', action='store_true', 
                         help='verbose output')
     
     args = parser.parse_args()
-    main(args.infile, verbose = args.verbose, outliers = args.outliers, dump_all = args.all)
+    # a bad query, or following a json file, is the user's mistake, not ours
+    try:
+        main(args.infile, verbose = args.verbose, outliers = args.outliers,
+             dump_all = args.all, cache = not args.no_index, interval = args.follow,
+             jobs = args.jobs, queries = args.query, limit = args.limit)
+    except ValueError as e:
+        parser.error(str(e))
     exit(0)